@@ -1,11 +1,13 @@
+import asyncio
+import json
 import logging
 import os
+import time
 from argparse import ArgumentParser
 
-from mistralai import Mistral
-
+from llm_handlers.mistral_handler import MistralHandler
 from utils.logger import filter_loggers
-from utils.mistral_handler import MistralCompletionHandler
+from utils.ocr import get_signed_url
 
 filter_loggers({'httpcore': 'ERROR'})
 
@@ -17,25 +19,108 @@ api_key = os.environ["MISTRAL_API_KEY"]
 parser = ArgumentParser(description="Upload a file to Mistral for OCR processing.")
 parser.add_argument('--file_id', type=str, help="File ID to use for OCR")  # 9d277797-a704-406c-bd99-a9803d0cf8f5
 parser.add_argument('--model', type=str, help="Model to use for chat completion", default="mistral-small-latest")
+parser.add_argument('--max_concurrency', type=int, help="Max number of concurrent chat completions", default=4)
+parser.add_argument('--use_batch', action='store_true',
+                    help="Submit all questions as a single Mistral batch job instead of concurrent completions")
+
+with open(os.path.join(os.path.dirname(__file__), "questions_ski.json"), "r", encoding="utf-8") as questions_file:
+    QUESTIONS: list[str] = json.load(questions_file)
+
+
+def build_messages(question: str, document_url: str) -> list[dict]:
+    return [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Il tuo compito è quello di rispondere in maniera chiara e concisa alla domanda, utilizzando il documento fornito come riferimento."
+                }
+            ]
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": question
+                },
+                {
+                    "type": "document_url",
+                    "document_url": document_url
+                }
+            ]
+        }
+    ]
+
+
+async def answer_questions(m_handler: MistralHandler, document_url: str, max_concurrency: int) -> list[str]:
+    """
+    Fire all chat completions concurrently, bounded by a semaphore; requests go through the handler,
+    which paces them within its rate limits, retries transient errors and tracks token usage.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def answer(question: str) -> str:
+        async with semaphore:
+            chat_response = await m_handler.ainvoke_with_retry(
+                "complete",
+                messages=build_messages(question, document_url),
+            )
+        return chat_response.choices[0].message.content
+
+    return await asyncio.gather(*[answer(question) for question in QUESTIONS])
+
+
+BATCH_TERMINAL_STATUSES = {"SUCCESS", "FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"}
+
+
+def answer_questions_with_batch(m_handler: MistralHandler, document_url: str, poll_interval: int = 10) -> list[str]:
+    """
+    Submit all questions as a single batch job (one JSONL line per question), wait for its completion
+    and parse the answers back in the same order as QUESTIONS.
+    Batch jobs have lower cost and higher rate limits, at the price of a longer turnaround time.
+    """
+    batch_lines = [
+        json.dumps({"custom_id": str(i), "body": {"messages": build_messages(question, document_url)}})
+        for i, question in enumerate(QUESTIONS)
+    ]
+    batch_file = m_handler.client.files.upload(
+        file={
+            "file_name": "questions.jsonl",
+            "content": "\n".join(batch_lines).encode("utf-8"),
+        },
+        purpose="batch"
+    )
+    batch_job = m_handler.client.batch.jobs.create(
+        input_files=[batch_file.id],
+        endpoint="/v1/chat/completions",
+        model=m_handler.chat_model,
+    )
+    logger.info(f"Batch job {batch_job.id} created with {len(batch_lines)} requests")
+    while batch_job.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch_job = m_handler.client.batch.jobs.get(job_id=batch_job.id)
+        logger.debug(f"Batch job {batch_job.id} status: {batch_job.status} "
+                     f"({batch_job.completed_requests}/{batch_job.total_requests})")
+    if batch_job.status != "SUCCESS":
+        raise RuntimeError(f"Batch job {batch_job.id} ended with status {batch_job.status}: {batch_job.errors}")
+
+    output = m_handler.client.files.download(file_id=batch_job.output_file)
+    answers = [""] * len(QUESTIONS)
+    for line in output.iter_lines():
+        if not line:
+            continue
+        result = json.loads(line)
+        answers[int(result["custom_id"])] = result["response"]["body"]["choices"][0]["message"]["content"]
+    return answers
 
-QUESTIONS = [
-    "In quale stagione è stata inaugurata la Coppa del Mondo di sci alpino?",
-    """Quali sono le discipline in cui si gareggia nella Coppa del Mondo di sci alpino?""",
-    """Come vengono assegnati i punti ai primi 30 classificati di ogni gara?""",
-    """Qual è il distacco massimo dal primo classificato oltre il quale non vengono assegnati punti ai concorrenti entro il 30º posto?""",
-    """Quale nazione ha vinto il maggior numero totale di Coppe del Mondo generali (maschili e femminili)?""",
-    """Oggi è il 2000: quando Mikaela Shiffrin farà il suo debutto in Coppa del Mondo di sci alpino?""",
-    """Se un atleta ottiene una media di 80 punti per gara e partecipa a 30 gare in una stagione, può vincere la Coppa del Mondo generale? (Considerando che mediamente il vincitore della Coppa del Mondo totalizza circa 1500-2000 punti in una stagione).""",
-    """In media in carriera, ogni quanti anni Marcel Hirsher ha vinto una coppa del mondo generale?""",
-    """Quanto tempo è trascorso in termini di anni tra le due vittorie della Coppa del Mondo Generale di Federica Brignone?""",
-    """Se la prima atleta all'arrivo conclude la gara con un tempo di 59"10, quale è il tempo massimo entro il quale un atleta che termina la gara nelle prime 30 posizioni deve arrivare per ottenere punti?""",
-]
 
 if __name__ == "__main__":
     args = parser.parse_args()
     file_id = args.file_id
     model = args.model
-    m_handler = MistralCompletionHandler(model=model)
+    m_handler = MistralHandler(chat_model=model)
 
     try:
         uploaded_pdf = m_handler.client.files.retrieve(file_id=file_id)
@@ -45,40 +130,11 @@ if __name__ == "__main__":
         exit(1)
 
     # Get the file URL
-    signed_url = m_handler.client.files.get_signed_url(file_id=file_id)
-
-    # Define the messages for the chat
-    for question in QUESTIONS:
-        messages = [
-            {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Il tuo compito è quello di rispondere in maniera chiara e concisa alla domanda, utilizzando il documento fornito come riferimento."
-                    }
-                ]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": question
-                    },
-                    {
-                        "type": "document_url",
-                        "document_url": signed_url.url
-                    }
-                ]
-            }
-        ]
-
-        # Get the chat response
-        chat_response = m_handler._complete_with_retry(
-            messages=messages
-        )
-
-        # Print the content of the response
-        answer = chat_response.choices[0].message.content
+    signed_url = get_signed_url(m_handler.client, file_id)
+
+    if args.use_batch:
+        answers = answer_questions_with_batch(m_handler, signed_url)
+    else:
+        answers = asyncio.run(answer_questions(m_handler, signed_url, args.max_concurrency))
+    for question, answer in zip(QUESTIONS, answers):
         logger.info(f'# Question: "{question}"\n# Answer: "{answer}"\n')
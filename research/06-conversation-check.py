@@ -19,22 +19,14 @@ filter_loggers({'httpcore': 'ERROR', 'httpx': 'ERROR'})
 logging.basicConfig(**LOG_CONFIG)
 logger = logging.getLogger(__name__)
 
-QUESTIONS = [
-    """In quale stagione è stata inaugurata la Coppa del Mondo di sci alpino?""",
-    """Quali sono le discipline in cui si gareggia nella Coppa del Mondo di sci alpino?""",
-    """Come vengono assegnati i punti ai primi 30 classificati di ogni gara?""",
-    """Qual è il distacco massimo dal primo classificato oltre il quale non vengono assegnati punti ai concorrenti entro il 30º posto?""",
-    """Quale nazione ha vinto il maggior numero totale di Coppe del Mondo generali (maschili e femminili)?""",
-    """Oggi è il 2000: quando Mikaela Shiffrin farà il suo debutto in Coppa del Mondo di sci alpino?""",
-    """Se un atleta ottiene una media di 80 punti per gara e partecipa a 30 gare in una stagione, può vincere la Coppa del Mondo generale? (Considerando che mediamente il vincitore della Coppa del Mondo totalizza circa 1500-2000 punti in una stagione).""",
-    """In media in carriera, ogni quanti anni Marcel Hirsher ha vinto una coppa del mondo generale?""",
-    """Quanto tempo è trascorso in termini di anni tra le due vittorie della Coppa del Mondo Generale di Federica Brignone?""",
-    """Se la prima atleta all'arrivo conclude la gara con un tempo di 59"10, quale è il tempo massimo entro il quale un atleta che termina la gara nelle prime 30 posizioni deve arrivare per ottenere punti?""",
-]
+# test questions on the Coppa del Mondo di sci alpino document, kept in a JSON asset
+with open(os.path.join(os.path.dirname(__file__), "questions_ski.json"), "r", encoding="utf-8") as questions_file:
+    QUESTIONS: list[str] = json.load(questions_file)
 
 parser = argparse.ArgumentParser(description="Test script for the conversation handler")
 parser.add_argument('--file_id', type=str, help="File ID to use for OCR")  # 9d277797-a704-406c-bd99-a9803d0cf8f5
 parser.add_argument('--model', type=str, help="Model to use for chat completion", choices=["mistral", "azure-openai"], default="azure_openai")
+parser.add_argument('--max_concurrency', type=int, help="Max number of questions answered concurrently", default=4)
 
 
 if __name__ == "__main__":
@@ -58,27 +50,39 @@ if __name__ == "__main__":
     tool_client = ToolClient(llm_handler=llm_handler, embeddings_handler=jina_handler,
                              collection_name=file_id)
 
-    output = []
-    for i, question in enumerate(QUESTIONS):
-        conversation_id = f"test-20250414-1215-q{i:02}"
-        input_dto = InputMessage(
-            conversation_id=conversation_id,
-            user_id="user_123",
-            message=question
-        )
-
-        conversation_handler = ConversationHandler(input_dto,
-                                                   conversation_db=conversation_db,
-                                                   tool_client=tool_client,
-                                                   llm_handler=llm_handler)
-        output_message = asyncio.run(conversation_handler.main())
+    async def answer_question(semaphore: asyncio.Semaphore, i: int, question: str) -> dict:
+        async with semaphore:
+            conversation_id = f"test-20250414-1215-q{i:02}"
+            input_dto = InputMessage(
+                conversation_id=conversation_id,
+                user_id="user_123",
+                message=question
+            )
+
+            conversation_handler = ConversationHandler(input_dto,
+                                                       conversation_db=conversation_db,
+                                                       tool_client=tool_client,
+                                                       llm_handler=llm_handler)
+            output_message = await conversation_handler.main()
         answer = output_message.message
         logger.info(f'# Question {i:02}: "{question}"\n# Answer: "{answer}"\n')
-        output.append({
+        return {
             "id": i,
             "question": question,
             "answer": answer
-        })
+        }
+
+    async def answer_questions() -> list[dict]:
+        # all questions run concurrently in the same event loop, which owns the async clients of the tool client;
+        # the semaphore bounds the number of conversations in flight to respect the LLM rate limits
+        semaphore = asyncio.Semaphore(args.max_concurrency)
+        try:
+            # gather preserves the order of the questions
+            return await asyncio.gather(*[answer_question(semaphore, i, q) for i, q in enumerate(QUESTIONS)])
+        finally:
+            await tool_client.aclose()
+
+    output = asyncio.run(answer_questions())
 
     # Save the output to a JSON file
     timestamp = datetime.datetime.now().isoformat().replace(":", "-")  # Replace invalid characters
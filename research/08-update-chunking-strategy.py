@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import logging
@@ -6,10 +7,11 @@ from argparse import ArgumentParser
 
 from mistralai import OCRResponse
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
 
 from llm_handlers.jina_handler import JinaHandler
-from preprocessing.chunking import ChunkWithEmbedding, add_overlap_to_chunks
+from preprocessing.chunking import add_overlap_to_chunks
+from preprocessing.embedding import aembed_and_upsert_chunks
+from utils.cache import EmbeddingCache
 from utils.logger import filter_loggers, LOG_CONFIG
 
 filter_loggers({'httpcore': 'ERROR', 'httpx': 'ERROR'})
@@ -20,6 +22,10 @@ logger = logging.getLogger(__name__)
 parser = ArgumentParser(description="Process Mistral OCR output to create chunks.")
 parser.add_argument('--ocr_output_file', type=str,
                     help="Path to the OCR output resposne")  # data/processed/ocr_result_9d277797-a704-406c-bd99-a9803d0cf8f5.json
+parser.add_argument('--max_concurrency', type=int, default=8,
+                    help="Max number of concurrent embedding requests")
+parser.add_argument('--emit_intermediate', action='store_true',
+                    help="Also save the chunks before embedding")
 
 qdrant_url = os.getenv('QDRANT_URL')
 qdrant_port = os.getenv('QDRANT_PORT')
@@ -28,17 +34,17 @@ if qdrant_url:
 else:
     logger.debug(f'loading local Qdrant client at "{os.getenv("QDRANT_PATH_TO_DB")}"')
     os.makedirs(os.getenv("QDRANT_PATH_TO_DB"), exist_ok=True)
-    qdrant_client = QdrantClient(path=os.getenv("QDRANT_PATH_TO_DB"))
+    qdrant_client = QdrantClient(path=os.getenv("QDRANT_PATH_TO_DB"), force_disable_check_same_thread=True)
 
 if __name__ == "__main__":
     args = parser.parse_args()
     ocr_output_file = args.ocr_output_file
     file_id = "9d277797-a704-406c-bd99-a9803d0cf8f5"  # TODO make argument
 
-    j_handler = JinaHandler(embed_model="jina-clip-v2")
+    j_handler = JinaHandler(embed_model="jina-clip-v2", max_concurrency=args.max_concurrency)
 
     with open(ocr_output_file, "r", encoding='utf-8') as jf:
-        ocr_response = OCRResponse(**json.load(jf))
+        ocr_response = OCRResponse.model_validate_json(jf.read())
 
     chunks = add_overlap_to_chunks(ocr_response)
 
@@ -46,42 +52,28 @@ if __name__ == "__main__":
     orig_file, ext = os.path.splitext(ocr_output_file)
     path, orig_filename = os.path.split(orig_file)
 
-    json_chunk_file = os.path.join(path, "chunked_" + orig_filename + ".json")
-    logger.info(f"Saving chunks with embeddings to {json_chunk_file}")
-    with open(json_chunk_file, "w", encoding="utf-8") as json_file:
-        json.dump([ce.model_dump() for ce in chunks], json_file)
-
-
-    chunks_with_embeddings = []
-    for chunk_to_embed in chunks:
-        logger.info(f'Chunking chunk {chunk_to_embed.id:02} with {len(chunk_to_embed.text)} characters')
-        if len(chunk_to_embed.text) == 0:
-            logger.warning('Empty chunk, skipping...')
-            continue
-        emb_resp = j_handler.invoke_with_retry("embed", messages=[chunk_to_embed.model_dump(include={"text"})], to_embed_key="text")
-        chunk_with_emb = ChunkWithEmbedding(id=chunk_to_embed.id, text=chunk_to_embed.text, embedding=emb_resp.data[0].embedding)
-        chunks_with_embeddings.append(chunk_with_emb)
-
-
-
-    logger.info("# 5. Create a collection in Qdrant")
-    # Create a collection in Qdrant
-    create_response = qdrant_client.create_collection(
-        collection_name=file_id,
-        vectors_config=VectorParams(size=len(chunks_with_embeddings[0].embedding), distance=Distance.COSINE),
-    )
-    logger.info(f"Collection '{file_id}' created successfully")
-
-
-    json_chunk_file = os.path.join(path, f"jinaai_embeddings_{orig_filename}_{datetime.date.today().strftime('%Y%m%d')}.json")
-    logger.info(f"Saving chunks with embeddings to {json_chunk_file}")
-    with open(json_chunk_file, "w", encoding="utf-8") as json_file:
-        json.dump([ce.model_dump() for ce in chunks_with_embeddings], json_file)
-
-    point_structs = [chunk.to_qdrant_point_struct(filename=json_chunk_file) for chunk in chunks_with_embeddings]
-    operation_info = qdrant_client.upsert(
-        collection_name=file_id,
-        wait=True,
-        points=point_structs
-    )
-    logger.info(f"upsert data output: {operation_info}")
\ No newline at end of file
+    if args.emit_intermediate:
+        json_chunk_file = os.path.join(path, "chunked_" + orig_filename + ".json")
+        logger.info(f"Saving chunks to {json_chunk_file}")
+        with open(json_chunk_file, "w", encoding="utf-8") as json_file:
+            json.dump([ce.model_dump() for ce in chunks], json_file)
+
+
+    non_empty_chunks = [c for c in chunks if len(c.text) > 0]
+    if len(non_empty_chunks) < len(chunks):
+        logger.warning(f'Skipping {len(chunks) - len(non_empty_chunks)} empty chunks')
+
+    json_chunk_file = os.path.join(path, f"jinaai_embeddings_{orig_filename}_{datetime.date.today().strftime('%Y%m%d')}.jsonl")
+
+    logger.info("# 5. Embed the chunks, save them and load them in a new Qdrant collection")
+    # embedding, saving and upsert are pipelined: batches are saved and upserted as soon as they are embedded
+    embedding_cache = EmbeddingCache()
+    try:
+        asyncio.run(aembed_and_upsert_chunks(j_handler, non_empty_chunks,
+                                             vector_db=qdrant_client,
+                                             collection_name=file_id,
+                                             embeddings_file=json_chunk_file,
+                                             cache=embedding_cache,
+                                             filename=json_chunk_file))
+    finally:
+        embedding_cache.close()
@@ -1,16 +1,22 @@
-import json
+import asyncio
 import logging
 import os
 from argparse import ArgumentParser
 
-from mistralai import Mistral, OCRResponse
+from mistralai import OCRResponse
+from pydantic import BaseModel
 from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
 
 from llm_handlers.jina_handler import JinaHandler
-from preprocessing.chunking import split_markdown_into_chunks, ChunkWithEmbedding, add_overlap_to_chunks
+from llm_handlers.mistral_handler import build_mistral_client
+from preprocessing.chunking import split_markdown_into_chunks, add_overlap_to_chunks
+from preprocessing.embedding import (aembed_chunks, dump_chunks_with_embeddings, iter_chunks_with_embeddings,
+                                     upload_chunks, QDRANT_QUANTIZATION_CONFIG)
+from utils.cache import CACHE_DIR, EmbeddingCache, file_digest, load_cached_text, store_cached_json
 from utils.logger import filter_loggers
-from utils.ocr import get_combined_markdown
+from utils.ocr import export_images, get_combined_markdown, get_signed_url
+from utils.retry import retry_on_transient
 
 filter_loggers({'httpcore': 'ERROR'})
 
@@ -28,8 +34,32 @@ else:
 
 api_key = os.environ["MISTRAL_API_KEY"]
 
-mistral_ocr_client = Mistral(api_key=api_key)
-jina_handler = JinaHandler(embed_model="jina-clip-v2")
+mistral_ocr_client = build_mistral_client(api_key=api_key)
+
+# Mistral calls are retried on rate limits / server errors with exponential backoff
+with_retry = retry_on_transient(max_attempts=3)
+
+
+class CachedOCRResult(BaseModel):
+    # layout of the OCR cache files, validated straight from their JSON text
+    file_id: str
+    ocr_response: OCRResponse
+
+
+@with_retry
+def upload_file(file_path: str):
+    # the file is opened at each attempt, so that a retry does not send an already consumed stream.
+    # The SDK hands the file object to httpx, which streams multipart file fields in small blocks,
+    # hence the file is never fully loaded in memory
+    with open(file_path, "rb") as f:
+        return mistral_ocr_client.files.upload(
+            file={
+                "file_name": os.path.basename(file_path),
+                "content": f,
+            },
+            purpose="ocr"
+        )
+
 
 parser = ArgumentParser(description="""
 Document preprocessing pipeline.
@@ -45,6 +75,8 @@ Steps:
 Use --file to specify the raw file to upload.
 """)
 parser.add_argument('--file_path', type=str, help="Path to the file to upload", required=False)
+parser.add_argument('--max_concurrency', type=int, help="Max number of concurrent embedding requests",
+                    required=False, default=8)
 # TODO implement --from_step and --to_step in code
 # parser.add_argument('--from_step', type=int, help="Step to start from", required=False, default=0)
 # parser.add_argument('--to_step', type=int, help="Step to end at", required=False, default=6)
@@ -52,54 +84,67 @@ parser.add_argument('--file_path', type=str, help="Path to the file to upload",
 if __name__ == "__main__":
     args = parser.parse_args()
     file_path = args.file_path
-
-
-
-    logger.info("# 1. Upload the file to Mistral")
-    uploaded_pdf = mistral_ocr_client.files.upload(
-        file={
-            "file_name": os.path.basename(file_path),
-            "content": open(file_path, "rb"),
-        },
-        purpose="ocr"
-    )
-    # Get the file ID
-    file_id = uploaded_pdf.id
-    logger.info(f"File uploaded successfully with ID: {file_id}")
-
-    # Get the file URL
-    signed_url = mistral_ocr_client.files.get_signed_url(file_id=file_id)
-
-
-
-    # Perform OCR
-    logger.info("# 2. Perform OCR on the uploaded file")
-    try:
-        ocr_result = mistral_ocr_client.ocr.process(
-            model="mistral-ocr-latest",
-            document={
-                "type": "document_url",
-                "document_url": signed_url.url,
-            })
-    except Exception as e:
-        logger.error(f"Error processing OCR for file with id {file_id}: {e}")
-        exit(1)
-
-    print(ocr_result.model_dump_json(indent=2))
+    jina_handler = JinaHandler(embed_model="jina-clip-v2", max_concurrency=args.max_concurrency)
+
+
+
+    # OCR results are cached on disk keyed by the file content hash: re-running on the same file
+    # skips both the upload and the OCR call
+    ocr_cache_file = os.path.join(CACHE_DIR, f"ocr_{file_digest(file_path)}.json")
+    cached_ocr_json = load_cached_text(ocr_cache_file)
+    if cached_ocr_json is not None:
+        logger.info(f'# 1-2. OCR result found in cache "{ocr_cache_file}", skipping upload and OCR')
+        cached_ocr = CachedOCRResult.model_validate_json(cached_ocr_json)
+        file_id = cached_ocr.file_id
+        ocr_result = cached_ocr.ocr_response
+    else:
+        logger.info("# 1. Upload the file to Mistral")
+        uploaded_pdf = upload_file(file_path)
+        # Get the file ID
+        file_id = uploaded_pdf.id
+        logger.info(f"File uploaded successfully with ID: {file_id}")
+
+        # Get the file URL
+        signed_url = with_retry(get_signed_url)(mistral_ocr_client, file_id)
+
+
+
+        # Perform OCR
+        logger.info("# 2. Perform OCR on the uploaded file")
+        try:
+            ocr_result = with_retry(mistral_ocr_client.ocr.process)(
+                model="mistral-ocr-latest",
+                document={
+                    "type": "document_url",
+                    "document_url": signed_url,
+                },
+                # images are returned as base64 data, then exported as side-car files
+                include_image_base64=True)
+        except Exception as e:
+            logger.error(f"Error processing OCR for file with id {file_id}: {e}")
+            exit(1)
+
+        # images are stored as side-car binary files, keeping the OCR JSON small
+        export_images(ocr_result, images_dir=f"data/processed/images/{file_id}")
+        store_cached_json(ocr_cache_file, {"file_id": file_id, "ocr_response": ocr_result.model_dump()})
+
+    # serialize once (pydantic serializer) and reuse it both for printing and storing
+    ocr_result_json = ocr_result.model_dump_json(indent=2)
+    print(ocr_result_json)
 
     # Store ocr_result as a json file with pages
     ocr_response_file_name = f"data/processed/ocr_result_{file_id}.json"
     with open(ocr_response_file_name, "w", encoding="utf-8") as json_file:
-        json_file.write(ocr_result.model_dump_json(indent=2))
+        json_file.write(ocr_result_json)
 
     # Store the result in a md file
     result_file_name = f"data/processed/ocr_result_{file_id}.md"
     with open(result_file_name, "w", encoding="utf-8") as result_file:
-        result_file.write(get_combined_markdown(ocr_result))
+        result_file.write(get_combined_markdown(ocr_result, images_dir=f"data/processed/images/{file_id}"))
 
 
     with open(ocr_response_file_name, "r", encoding='utf-8') as f:
-        ocr_response = OCRResponse(**json.load(f))
+        ocr_response = OCRResponse.model_validate_json(f.read())
 
 
     logger.info("# 3. Split the markdown into chunks")
@@ -109,21 +154,20 @@ if __name__ == "__main__":
 
 
     logger.info("# 4. Embed the chunks")
-    chunks_with_embeddings = []
-    for i, chunk in enumerate(chunks):
-        logger.info(f'Chunking chunk {chunk.id:02} with {len(chunk.text)} characters')
-        emb_resp = jina_handler.invoke_with_retry("embed", messages=[chunk.model_dump(include={'text'})], to_embed_key="text")
-        chunk_with_emb = ChunkWithEmbedding(id=chunk.id, text=chunk.text, embedding=emb_resp.data[0].embedding)
-        chunks_with_embeddings.append(chunk_with_emb)
+    # embeddings of chunks already seen (e.g. re-running on the same file) are read from the cache
+    embedding_cache = EmbeddingCache()
+    try:
+        chunks_with_embeddings = asyncio.run(aembed_chunks(jina_handler, chunks, cache=embedding_cache))
+    finally:
+        embedding_cache.close()
 
     # Save the chunks with embeddings to a JSON file
     file, ext = os.path.splitext(result_file_name)
     path, filename = os.path.split(file)
 
-    json_chunk_file = os.path.join(path, "jinaai_embeddings_" + filename + ".json")
+    json_chunk_file = os.path.join(path, "jinaai_embeddings_" + filename + ".jsonl")
     logger.info(f"Saving chunks with embeddings to {json_chunk_file}")
-    with open(json_chunk_file, "w", encoding="utf-8") as json_file:
-        json.dump([ce.model_dump() for ce in chunks_with_embeddings], json_file)
+    dump_chunks_with_embeddings(json_chunk_file, chunks_with_embeddings)
 
 
 
@@ -132,6 +176,7 @@ if __name__ == "__main__":
     create_response = qdrant_client.create_collection(
         collection_name=file_id,
         vectors_config=VectorParams(size=len(chunks_with_embeddings[0].embedding), distance=Distance.COSINE),
+        quantization_config=QDRANT_QUANTIZATION_CONFIG,
     )
     logger.info(f"Collection '{file_id}' created successfully")
 
@@ -139,13 +184,7 @@ if __name__ == "__main__":
 
     logger.info("# 6. Load the embeddings into Qdrant")
     # Load embeddings in Qdrant
-    with open(json_chunk_file, "r", encoding='utf-8') as f:
-        all_embeddings = json.load(f)
-
-    embedded_chunks = [ChunkWithEmbedding.from_json_elem(elem) for elem in all_embeddings]
-    point_structs = [chunk.to_qdrant_point_struct(filename=json_chunk_file) for chunk in embedded_chunks]
-    operation_info = qdrant_client.upsert(
-        collection_name=file_id,
-        wait=True,
-        points=point_structs
-    )
+    # chunks are streamed from file to the batched and parallel upload,
+    # with indexing deferred until all points are loaded
+    embedded_chunks = iter_chunks_with_embeddings(json_chunk_file)
+    upload_chunks(qdrant_client, collection_name=file_id, chunks=embedded_chunks, filename=json_chunk_file)
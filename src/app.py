@@ -1,9 +1,10 @@
 import logging
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
 from dotenv import load_dotenv, find_dotenv
-from fastapi import FastAPI, WebSocket
+from fastapi import Depends, FastAPI, WebSocket
 from fastapi.responses import HTMLResponse
 
 from llm_handlers.azure_openai_handler import AzureOpenaiHandler
@@ -20,21 +21,44 @@ logging.basicConfig(**LOG_CONFIG)
 
 logger = logging.getLogger(__name__)
 
-logger.info('Starting up...')
 
-# LLM Handlers
-llm_handler = AzureOpenaiHandler(chat_model="crif-genai-gpt-4.1-2025-04-14")
-jina_handler = JinaHandler(embed_model="jina-clip-v2")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create handlers and clients once per application, so that their connection pools
+    are shared by all websocket connections, and release them on shutdown.
+    """
+    logger.info('Starting up...')
+    # LLM Handlers
+    app.state.llm_handler = AzureOpenaiHandler(chat_model="crif-genai-gpt-4.1-2025-04-14")
+    app.state.jina_handler = jina_handler = JinaHandler(embed_model="jina-clip-v2")
 
-# fake key-value db
-conversation_db = {}
+    # fake key-value db
+    app.state.conversation_db = {}
 
-tool_client = ToolClient(llm_handler=llm_handler, embeddings_handler=jina_handler,
-                         collection_name="9d277797-a704-406c-bd99-a9803d0cf8f5")
+    app.state.tool_client = ToolClient(llm_handler=app.state.llm_handler, embeddings_handler=jina_handler,
+                                       collection_name="9d277797-a704-406c-bd99-a9803d0cf8f5")
+    logger.info('Starting up... done!')
+    yield
+    # release the async connection pools of the tool client and the sync pools of the handlers on shutdown
+    await app.state.tool_client.aclose()
+    app.state.jina_handler.close()
+    app.state.llm_handler.close()
 
-logger.info('Starting up... done!')
 
-app = FastAPI()
+def get_llm_handler(websocket: WebSocket) -> AzureOpenaiHandler:
+    return websocket.app.state.llm_handler
+
+
+def get_tool_client(websocket: WebSocket) -> ToolClient:
+    return websocket.app.state.tool_client
+
+
+def get_conversation_db(websocket: WebSocket) -> dict:
+    return websocket.app.state.conversation_db
+
+
+app = FastAPI(lifespan=lifespan)
 
 HTML = """
 <!DOCTYPE HTML>
@@ -77,7 +101,10 @@ async def get():
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket,
+                             llm_handler: AzureOpenaiHandler = Depends(get_llm_handler),
+                             tool_client: ToolClient = Depends(get_tool_client),
+                             conversation_db: dict = Depends(get_conversation_db)):
     await websocket.accept()
     while True:
         logger.info("Waiting for message...")
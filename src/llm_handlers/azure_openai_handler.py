@@ -1,9 +1,8 @@
 import logging
 import os
-import time
-from typing import Literal
 
-from openai import AzureOpenAI
+import httpx
+from openai import APIConnectionError, AzureOpenAI
 from openai.types import CreateEmbeddingResponse
 from openai.types.chat import ChatCompletion
 
@@ -12,30 +11,38 @@ from llm_handlers.base_handler import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+AZURE_OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
 
 class AzureOpenaiHandler(BaseHandler):
-    def __init__(self, chat_model: str = "crif-genai-gpt-4.1-2025-04-14", embed_model: str = "crif-genai-text-embedding-3-small"):
-        super().__init__(rps_limit=250 * 60, tpm_limit=250000)
+    def __init__(self, chat_model: str = "crif-genai-gpt-4.1-2025-04-14", embed_model: str = "crif-genai-text-embedding-3-small",
+                 max_retries: int = 5):
+        super().__init__(rps_limit=250, tpm_limit=250000, max_retries=max_retries)
         self.chat_model = chat_model
         self.embed_model = embed_model
         self.client = AzureOpenAI(
             azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
             api_version=os.getenv('AZURE_OPENAI_API_VERSION'),
             api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+            # retries are owned by BaseHandler, SDK retries would multiply its retry budget
+            max_retries=0,
+            # long-lived HTTP/2 connection pool, shared by concurrent conversations
+            http_client=httpx.Client(http2=True, limits=AZURE_OPENAI_HTTP_LIMITS),
         )
 
-    def update_state(self, response: ChatCompletion):
+    def update_state(self, response: ChatCompletion | CreateEmbeddingResponse):
         """
         Update the state of the handler with the response from the Azure OpenAI API.
 
         Parameters:
-            response (ChatCompletion): The response from the Azure OpenAI API.
+            response (ChatCompletion | CreateEmbeddingResponse): The response from the Azure OpenAI API.
         """
-        self.token_usage['total_tokens'] += response.usage.total_tokens
-        self.token_usage['prompt_tokens'] += response.usage.prompt_tokens
-        self.token_usage['completion_tokens'] += response.usage.completion_tokens
-        request_time = time.time()
-        self.update_last_minute_state(request_time)
+        self.token_usage.total_tokens += response.usage.total_tokens
+        self.token_usage.prompt_tokens += response.usage.prompt_tokens
+        # embedding usage has no completion tokens
+        self.token_usage.completion_tokens += getattr(response.usage, "completion_tokens", 0)
+        self.record_usage(response.usage)
+        self.consume_tokens(response.usage.total_tokens)
 
     def _complete(self, messages: list[dict], **chat_complete_kwargs) -> ChatCompletion:
         response = self.client.chat.completions.create(
@@ -55,52 +62,25 @@ class AzureOpenaiHandler(BaseHandler):
         self.update_state(response)
         return response
 
-    def _embed(self, messages: list[dict], **embeddings_create_kwargs) ->  CreateEmbeddingResponse:
-        if "to_embed_key" not in embeddings_create_kwargs:
-            raise ValueError("to_embed_key must be provided for embedding.")
-        to_embed_key = embeddings_create_kwargs.pop('to_embed_key')
-        sentences = [m.get(to_embed_key) for m in messages]
+    def _embed(self, texts: list[str], **embeddings_create_kwargs) ->  CreateEmbeddingResponse:
+        unique_texts, text_positions = self.dedupe_texts(texts)
         response = self.client.embeddings.create(
-            input=messages,
+            input=unique_texts,
             model=self.embed_model,
             **embeddings_create_kwargs
         )
         self.update_state(response)
+        if len(unique_texts) < len(texts):
+            # duplicated texts share the embedding of their unique text
+            data = [response.data[p].model_copy(update={'index': i}) for i, p in enumerate(text_positions)]
+            response = response.model_copy(update={'data': data})
         return response
 
-
-    def invoke_with_retry(self,
-                          method: Literal["complete", "parse", "embed"],
-                          **invoke_kwargs) -> ChatCompletion | CreateEmbeddingResponse:
+    def close(self):
         """
-        Return the response from the Azure OpenAI API with retry logic for rate limits.
-
-        Args:
-            method (str): The method to call on the Azure OpenAI API.
-            **kwargs: Keyword arguments for the method.
-
-        Returns:
-            ChatCompletion: The response from the Azure OpenAI API.
+        Close the pooled HTTP client.
         """
-        self.wait_if_rps_limit()
-        try:
-            if method == "complete":
-                response = self._complete(**invoke_kwargs)
-            elif method == "parse":
-                response = self._parse(**invoke_kwargs)
-            elif method == "embed":
-                response = self._embed(**invoke_kwargs)
-            else:
-                raise ValueError(f"Unknown method: {method}")
-        except Exception as e:
-            logger.warning(f'method {method} failed. Try again (waiting if TPM limit). Current error: {e}')
-            self.wait_if_tpm_limit()
-            try:
-                logger.debug('second invocation (after tpm or not)')
-                response = self.invoke_with_retry(method, **invoke_kwargs)
-            except Exception as retry_exception:
-                # try and raise again the error in case it was not a problem of TPM
-                logger.error(f"Retry failed: {retry_exception}")
-                raise retry_exception
-        return response
+        self.client.close()
 
+    def is_transient_error(self, e: Exception) -> bool:
+        return super().is_transient_error(e) or isinstance(e, APIConnectionError)
@@ -1,28 +1,84 @@
+import asyncio
 import logging
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
 from typing import Any, Callable, Literal
 
+from utils.retry import is_transient_error, retry_wait_time
+
 logger = logging.getLogger(__name__)
 
+# usage events retained for export, and the batch size / interval (in seconds) of their export to `usage_sink`
+USAGE_EVENTS_MAX = 10_000
+USAGE_FLUSH_SIZE = 50
+USAGE_FLUSH_INTERVAL = 5.0
+# rough number of characters per token, used to estimate the tokens of a request before sending it
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_prompt_tokens(messages: list[dict] | None) -> int:
+    """
+    Estimate the prompt tokens of chat messages from the length of their contents.
+    """
+    if not messages:
+        return 0
+    return sum(estimate_tokens(str(message.get("content") or "")) for message in messages)
+
+
+@dataclass(slots=True)
+class TokenUsage:
+    """
+    Tokens used by a handler, updated on every response.
+    """
+    total_tokens: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
 class BaseHandler(ABC):
     """
     Abstract base class for LLM handlers.
     It implements two abstract methods: `update_state` and `invoke_with_retry`.
 
     The `update_state` method is used to update the state of the handler with tokens usage.
-    The `invoke_with_retry` method is used to handle the request and return a response.
+    The `invoke_with_retry` method is used to handle the request and return a response,
+    dispatching it to the `_complete`, `_parse` or `_embed` method with retries on transient errors.
     Underlying classes should implement these methods to provide specific functionality.
     """
 
-    def __init__(self, rps_limit: int | None = None, tpm_limit: int | None = None):
-        self.token_usage = {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+    def __init__(self, rps_limit: int | None = None, tpm_limit: int | None = None, max_retries: int = 5):
+        self.token_usage = TokenUsage()
         self.last_request_time: float | None = None
+        # requests per second and tokens per minute
         self.rps_limit = rps_limit
         self.tpm_limit = tpm_limit
-        self.tokens_in_minute: int = 0
-        self.requests_in_minute: int = 0
-
+        # token buckets: `tokens` refill continuously up to the limit, requests and used tokens consume them
+        now = time.monotonic()
+        self._rps_bucket = {'tokens': float(rps_limit or 0), 'last_refill': now}
+        self._tpm_bucket = {'tokens': float(tpm_limit or 0), 'last_refill': now}
+        self._bucket_lock = threading.Lock()
+        self.max_retries = max_retries
+        # dispatch table of invokable methods
+        self.methods: dict[str, Callable] = {
+            "complete": self._complete,
+            "parse": self._parse,
+            "embed": self._embed,
+        }
+        # dispatch table of invokable coroutine methods, for handlers supporting async calls
+        self.async_methods: dict[str, Callable] = {}
+        # methods sending several requests, each one rate limited and retried on its own with `call_with_retry`
+        self.self_retrying_methods: frozenset[str] = frozenset()
+        # usage events (timestamp, usage) exported in batches to `usage_sink` (e.g. a metrics exporter), if set
+        self.usage_sink: Callable[[list[tuple[float, Any]]], None] | None = None
+        self.usage_events: deque[tuple[float, Any]] = deque(maxlen=USAGE_EVENTS_MAX)
+        self._last_usage_flush = time.monotonic()
 
     @abstractmethod
     def update_state(self, response: Any):
@@ -38,41 +94,233 @@ class BaseHandler(ABC):
     def _parse(self, messages: list[dict], *args, **kwargs): pass
 
     @abstractmethod
-    def _embed(self, messages: list[dict], *args, **kwargs): pass
+    def _embed(self, texts: list[str], *args, **kwargs): pass
+
+    def record_usage(self, usage: Any):
+        """
+        Queue the usage of a response for export. Events are sent to `usage_sink` in batches, from a background
+        thread, once `USAGE_FLUSH_SIZE` of them are queued or every `USAGE_FLUSH_INTERVAL` seconds, so that
+        exporting never adds a network call per request.
+
+        Parameters:
+            usage (Any): The usage info of the response.
+        """
+        self.usage_events.append((time.time(), usage))  # deque.append is thread-safe
+        if self.usage_sink is None:
+            return
+        now = time.monotonic()
+        if len(self.usage_events) >= USAGE_FLUSH_SIZE or now - self._last_usage_flush >= USAGE_FLUSH_INTERVAL:
+            self._last_usage_flush = now
+            self.flush_usage_events()
+
+    def flush_usage_events(self):
+        """
+        Send the queued usage events to `usage_sink` in a background thread. Failures are only logged.
+        """
+        events = []
+        while self.usage_events:
+            try:
+                events.append(self.usage_events.popleft())
+            except IndexError:  # drained by a concurrent flush
+                break
+        if not events or self.usage_sink is None:
+            return
+
+        def export():
+            try:
+                self.usage_sink(events)
+            except Exception as e:
+                logger.warning(f'usage export failed: {e}')
+
+        threading.Thread(target=export, daemon=True).start()
+
+    @staticmethod
+    def prewarm_connection(request: Callable, *args, **kwargs):
+        """
+        Send a trivial request in a background thread, so that the TCP/TLS connection of the pooled client
+        is already established when the first real request is sent. Failures are only logged.
+
+        Args:
+            request: The client method sending the request.
+            *args, **kwargs: The arguments of the request.
+        """
+        def warm_up():
+            try:
+                request(*args, **kwargs)
+            except Exception as e:
+                logger.debug(f'connection pre-warming failed: {e}')
+
+        threading.Thread(target=warm_up, daemon=True).start()
+
+    @staticmethod
+    def dedupe_texts(texts: list[str]) -> tuple[list[str], list[int]]:
+        """
+        Deduplicate the inputs of an embedding request, so that repeated texts are embedded (and billed) once.
+
+        Args:
+            texts: The texts to embed.
+
+        Returns:
+            tuple[list[str], list[int]]: The unique texts, in order of first occurrence,
+                and for each input text the position of its unique text.
+        """
+        unique_positions: dict[str, int] = {}
+        text_positions = [unique_positions.setdefault(text, len(unique_positions)) for text in texts]
+        return list(unique_positions), text_positions
+
+    def is_transient_error(self, e: Exception) -> bool:
+        """
+        Whether an error of the underlying client is worth retrying (see `utils.retry.is_transient_error`).
+        Handlers may extend it with client specific errors.
+        """
+        return is_transient_error(e)
 
-    def invoke_with_retry(self, method: Literal["complete", "parse", "embed"], *args, **kwargs) -> Any:
+    def invoke_with_retry(self, method: Literal["complete", "parse", "embed"], **invoke_kwargs) -> Any:
         """
         Handle the request and return a response.
+        Transient errors (rate limits, server and connection errors) are retried up to `max_retries` times
+        with exponential backoff, any other error is raised immediately.
+        Methods in `self_retrying_methods` send several requests and retry each of them on its own
+        (see `call_with_retry`), hence they are invoked once here.
+
+        Args:
+            method: The method to invoke, either "complete", "parse" or "embed".
+            **invoke_kwargs: Additional parameters for client methods invocation.
         """
-        # TODO understand if this may be generalized here
-        pass
+        invoke = self.methods.get(method)
+        if invoke is None:
+            raise ValueError(f"Unknown method: {method}. Use one of {list(self.methods)}.")
+        if method in self.self_retrying_methods:
+            return invoke(**invoke_kwargs)
+        # estimated prompt tokens are reserved in the TPM bucket before the request
+        prompt_tokens = estimate_prompt_tokens(invoke_kwargs.get("messages"))
+        return self.call_with_retry(method, invoke, prompt_tokens, **invoke_kwargs)
 
-    def update_last_minute_state(self, request_time: float):
+    async def ainvoke_with_retry(self, method: Literal["complete", "parse", "embed"], **invoke_kwargs) -> Any:
         """
-        Update number of requests and number of  tokens used in the last minute comparing current to last request time.
+        Async version of `invoke_with_retry`, dispatching the request to the coroutine methods in `async_methods`:
+        waits (for rate limits and before retries) do not block the event loop, so that many requests can be in flight.
+        Handlers without a coroutine version of `method` run `invoke_with_retry` in a worker thread instead.
+
+        Args:
+            method: The method to invoke, either "complete", "parse" or "embed".
+            **invoke_kwargs: Additional parameters for client methods invocation.
         """
-        if self.last_request_time is not None and (request_time - self.last_request_time) < 60:
-            self.requests_in_minute += 1
-            self.tokens_in_minute += self.token_usage['total_tokens']
-        else:
-            self.requests_in_minute = 0
-            self.tokens_in_minute = 0
-        self.last_request_time = request_time
+        invoke = self.async_methods.get(method)
+        if invoke is None:
+            if method in self.methods:
+                return await asyncio.to_thread(self.invoke_with_retry, method, **invoke_kwargs)
+            raise ValueError(f"Unknown async method: {method}. Use one of {list(self.methods)}.")
+        if method in self.self_retrying_methods:
+            return await invoke(**invoke_kwargs)
+        prompt_tokens = estimate_prompt_tokens(invoke_kwargs.get("messages"))
+        return await self.acall_with_retry(method, invoke, prompt_tokens, **invoke_kwargs)
 
-    def wait_if_tpm_limit(self):
-        if self.tpm_limit is None:
-            return  # nothing to do here
-        if self.tokens_in_minute >= self.tpm_limit:
-            elapsed_time = time.time() - self.last_request_time
-            logger.warning(f"TPM limit exceeded. Sleeping for {60 - elapsed_time:.2f} seconds.")
-            time.sleep(60 - elapsed_time)
+    def call_with_retry(self, name: str, request: Callable, prompt_tokens: int = 0, **request_kwargs) -> Any:
+        """
+        Send a single request, reserving a rate limit slot (and the `prompt_tokens` estimated for it) before
+        each attempt and retrying transient errors up to `max_retries` times.
+        The reserved tokens are refunded after each attempt, since responses charge their actual usage
+        (see `consume_tokens`).
 
-    def wait_if_rps_limit(self):
-        if self.rps_limit is None:
-            return  # nothing to do here
-        if self.requests_in_minute > self.rps_limit:
-            request_time = time.time()
-            elapsed_time = request_time - self.last_request_time
-            logger.warning(f"RPS limit exceeded. Sleeping for {60 - elapsed_time:.2f} seconds.")
-            time.sleep(60 - elapsed_time)
+        Args:
+            name: The name of the request, for logging.
+            request: The function sending the request.
+            prompt_tokens: The estimated prompt tokens of the request.
+            **request_kwargs: The parameters of the request.
+        """
+        for attempt in range(self.max_retries):
+            self._acquire(tokens=prompt_tokens)
+            try:
+                return request(**request_kwargs)
+            except Exception as e:
+                # errors such as bad requests or authentication fail fast, retries are only for transient errors
+                if not self.is_transient_error(e) or attempt == self.max_retries - 1:
+                    logger.error(f'method {name} failed after {attempt + 1} attempts: {e}')
+                    raise
+                wait_time = retry_wait_time(e, attempt)
+                logger.warning(f'method {name} failed. Retrying in {wait_time:.2f} seconds. Current error: {e}')
+                time.sleep(wait_time)
+            finally:
+                self.consume_tokens(-prompt_tokens)
+
+    async def acall_with_retry(self, name: str, request: Callable, prompt_tokens: int = 0, **request_kwargs) -> Any:
+        """
+        Async version of `call_with_retry`, for coroutine functions.
+        """
+        for attempt in range(self.max_retries):
+            await self._aacquire(tokens=prompt_tokens)
+            try:
+                return await request(**request_kwargs)
+            except Exception as e:
+                if not self.is_transient_error(e) or attempt == self.max_retries - 1:
+                    logger.error(f'method {name} failed after {attempt + 1} attempts: {e}')
+                    raise
+                wait_time = retry_wait_time(e, attempt)
+                logger.warning(f'method {name} failed. Retrying in {wait_time:.2f} seconds. Current error: {e}')
+                await asyncio.sleep(wait_time)
+            finally:
+                self.consume_tokens(-prompt_tokens)
+
+    @staticmethod
+    def _refill(bucket: dict, capacity: float, rate: float, now: float):
+        bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['last_refill']) * rate)
+        bucket['last_refill'] = now
 
+    def _reserve(self, cost: int = 1, tokens: int = 0) -> float:
+        """
+        Reserve a request slot, returning how long to wait before sending the request: the RPS bucket
+        must have refilled the `cost` tokens consumed by the request, and the TPM bucket must have paid back
+        the token debt left by previous responses and by the `tokens` reserved for the request.
+        Buckets are updated at once, so that concurrent callers get consecutive slots.
+
+        Parameters:
+            cost (int): The number of requests to reserve.
+            tokens (int): The (estimated) number of prompt tokens to reserve.
+
+        Returns:
+            float: The waiting time in seconds.
+        """
+        with self._bucket_lock:
+            now = time.monotonic()
+            wait_time = 0.0
+            if self.rps_limit is not None:
+                self._refill(self._rps_bucket, self.rps_limit, self.rps_limit, now)
+                self._rps_bucket['tokens'] -= cost
+                wait_time = max(wait_time, -self._rps_bucket['tokens'] / self.rps_limit)
+            if self.tpm_limit is not None:
+                self._refill(self._tpm_bucket, self.tpm_limit, self.tpm_limit / 60, now)
+                self._tpm_bucket['tokens'] -= tokens
+                wait_time = max(wait_time, -self._tpm_bucket['tokens'] / (self.tpm_limit / 60))
+            self.last_request_time = now + wait_time
+        if wait_time > 0:
+            logger.warning(f"Rate limit reached. Sleeping for {wait_time:.2f} seconds.")
+        return wait_time
+
+    def _acquire(self, cost: int = 1, tokens: int = 0):
+        """
+        Wait until a request can be sent (see `_reserve`).
+        """
+        if (wait_time := self._reserve(cost, tokens)) > 0:
+            time.sleep(wait_time)
+
+    async def _aacquire(self, cost: int = 1, tokens: int = 0):
+        """
+        Async version of `_acquire`.
+        """
+        if (wait_time := self._reserve(cost, tokens)) > 0:
+            await asyncio.sleep(wait_time)
+
+    def consume_tokens(self, tokens: int):
+        """
+        Consume the tokens used by a response from the TPM bucket. Tokens are known only once the response
+        is received, hence the bucket can go below zero: the debt is waited for by the next request.
+
+        Parameters:
+            tokens (int): The number of tokens used by the response.
+        """
+        if self.tpm_limit is None:
+            return  # nothing to do here
+        with self._bucket_lock:
+            self._refill(self._tpm_bucket, self.tpm_limit, self.tpm_limit / 60, time.monotonic())
+            self._tpm_bucket['tokens'] -= tokens
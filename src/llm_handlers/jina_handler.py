@@ -1,37 +1,48 @@
+import asyncio
 import logging
 import os
 import time
-from typing import Literal
+from dataclasses import dataclass, field, replace
+from typing import Literal, NamedTuple
 
 import httpx
-import requests
-from pydantic import BaseModel
-from requests import Response
+from pydantic_core import from_json
 
 from llm_handlers.base_handler import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# keep-alive connections survive the typical gap between two embedding batches
+JINA_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=15)
+# micro-batching of single embedding requests (see `JinaHandler.embed_batched`)
+EMBED_MAX_BATCH = 32
+EMBED_MAX_WAIT = 0.01
 
-class JinaEmbeddingUsage(BaseModel):
+
+# responses are plain data containers built on every API call: slotted dataclasses, no validation
+@dataclass(slots=True, frozen=True)
+class JinaEmbeddingUsage:
     total_tokens: int = 0
     prompt_tokens: int = 0
 
 
-class JinaVector(BaseModel):
-    object: Literal["embedding"] = "embedding"
+class JinaVector(NamedTuple):
+    # a plain tuple: embeddings are passed through as returned by the API, without per-vector validation
+    embedding: list[float]
     index: int = 0
-    embedding: list[float] = []
+    object: Literal["embedding"] = "embedding"
 
 
-class JinaEmbeddingResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class JinaEmbeddingResponse:
     usage: JinaEmbeddingUsage
-    data: list[JinaVector] = []
+    data: list[JinaVector] = field(default_factory=list)
 
     @classmethod
-    def from_response(cls, response: Response) -> "JinaEmbeddingResponse":
+    def from_response(cls, response: httpx.Response) -> "JinaEmbeddingResponse":
         """
         Create a JinaEmbeddingResponse object from an HTTP response.
+        The response is trusted: neither usage nor vectors are validated.
 
         Args:
             response (httpx.Response): The HTTP response object.
@@ -39,14 +50,25 @@ class JinaEmbeddingResponse(BaseModel):
         Returns:
             JinaEmbeddingResponse: The JinaEmbeddingResponse object.
         """
-        data = response.json()
-        usage = JinaEmbeddingUsage(**data.get("usage", {}))
-        vectors = [JinaVector(**vector) for vector in data.get("data", [])]
+        # pydantic-core JSON parser, faster than the stdlib decoder of `response.json()` on large float arrays
+        data = from_json(response.content)
+        raw_usage = data.get("usage", {})
+        usage = JinaEmbeddingUsage(raw_usage.get("total_tokens", 0), raw_usage.get("prompt_tokens", 0))
+        vectors = [JinaVector(vector["embedding"], vector.get("index", i)) for i, vector in enumerate(data.get("data", []))]
         return cls(usage=usage, data=vectors)
 
+    def scatter(self, text_positions: list[int]) -> "JinaEmbeddingResponse":
+        """
+        Expand the response of a deduplicated request (see `BaseHandler.dedupe_texts`) to the original inputs,
+        duplicated texts sharing the embedding of their unique text.
+        """
+        data = [self.data[p]._replace(index=i) for i, p in enumerate(text_positions)]
+        return replace(self, data=data)
+
 
 class JinaHandler(BaseHandler):
-    def __init__(self, embed_model: str = "jina-clip-v2"):
+    def __init__(self, embed_model: str = "jina-clip-v2", max_concurrency: int = 8, min_request_interval: float = 0.1,
+                 prewarm: bool = True):
         super().__init__()
         self.url = 'https://api.jina.ai/v1/embeddings'
         self.headers = {
@@ -55,6 +77,30 @@ class JinaHandler(BaseHandler):
         }
         self.embed_model = embed_model
 
+        # sync state: a pooled HTTP/2 client, so that keep-alive connections are reused across requests
+        self.client = httpx.Client(
+            http2=True,
+            headers=self.headers,
+            verify=False,
+            timeout=30,
+            limits=JINA_HTTP_LIMITS,
+        )
+        if prewarm:
+            self.prewarm_connection(self.client.head, self.url)
+
+        # async state: a long-lived client (created lazily inside the running event loop),
+        # a semaphore bounding in-flight requests and a minimum interval between two requests
+        self.async_client: httpx.AsyncClient | None = None
+        self.min_request_interval = min_request_interval
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pacing_lock = asyncio.Lock()
+        self._last_async_request_time: float = 0.0
+        self.async_methods = {"embed": self._aembed}
+        # micro-batching state, created lazily inside the running event loop
+        self._batch_queue: asyncio.Queue | None = None
+        self._batch_task: asyncio.Task | None = None
+        self._batch_requests: set[asyncio.Task] = set()
+
     def update_state(self, response: JinaEmbeddingResponse):
         """
         Update the state of the handler with the response from the Jina AI API.
@@ -62,59 +108,136 @@ class JinaHandler(BaseHandler):
         Parameters:
 
         """
-        self.token_usage['total_tokens'] += response.usage.total_tokens
-        self.token_usage['prompt_tokens'] += response.usage.prompt_tokens
+        self.token_usage.total_tokens += response.usage.total_tokens
+        self.token_usage.prompt_tokens += response.usage.prompt_tokens
+        self.record_usage(response.usage)
 
-    def _embed(self, messages: list[dict], **embeddings_create_kwargs) -> JinaEmbeddingResponse:
-        if "to_embed_key" not in embeddings_create_kwargs:
-            raise ValueError("to_embed_key must be provided for embedding.")
-        to_embed_key = embeddings_create_kwargs.pop('to_embed_key')
+    def _embed(self, texts: list[str], **embeddings_create_kwargs) -> JinaEmbeddingResponse:
+        unique_texts, text_positions = self.dedupe_texts(texts)
         data = {
             'model': self.embed_model,
-            'input': [{'text': m.get(to_embed_key)} for m in messages],
+            # plain strings are accepted as text inputs, no need to wrap each of them in a {'text': ...} object
+            'input': unique_texts,
             **embeddings_create_kwargs
         }
-        response = requests.post(self.url, headers=self.headers, json=data, verify=False)
+        response = self.client.post(self.url, json=data)
         response.raise_for_status()
         jina_embedding_response = JinaEmbeddingResponse.from_response(response)
         self.update_state(jina_embedding_response)
+        if len(unique_texts) < len(texts):
+            jina_embedding_response = jina_embedding_response.scatter(text_positions)
         return jina_embedding_response
 
-    def _complete(self, messages: list[dict], *args, **kwargs):
-        raise NotImplemented
-
-    def _parse(self, messages: list[dict], *args, **kwargs):
-        raise NotImplemented
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(
+                http2=True,
+                headers=self.headers,
+                verify=False,
+                timeout=60,
+                limits=JINA_HTTP_LIMITS,
+            )
+        return self.async_client
+
+    async def _wait_min_request_interval(self):
+        """
+        Pace async requests so that two consecutive requests are at least `min_request_interval` seconds apart.
+        """
+        async with self._pacing_lock:
+            wait_time = self._last_async_request_time + self.min_request_interval - time.monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            self._last_async_request_time = time.monotonic()
+
+    async def _aembed(self, texts: list[str], **embeddings_create_kwargs) -> JinaEmbeddingResponse:
+        unique_texts, text_positions = self.dedupe_texts(texts)
+        data = {
+            'model': self.embed_model,
+            # plain strings are accepted as text inputs, no need to wrap each of them in a {'text': ...} object
+            'input': unique_texts,
+            **embeddings_create_kwargs
+        }
+        async with self._semaphore:
+            await self._wait_min_request_interval()
+            response = await self._get_async_client().post(self.url, json=data)
+        response.raise_for_status()
+        jina_embedding_response = JinaEmbeddingResponse.from_response(response)
+        self.update_state(jina_embedding_response)
+        if len(unique_texts) < len(texts):
+            jina_embedding_response = jina_embedding_response.scatter(text_positions)
+        return jina_embedding_response
 
-    def invoke_with_retry(self,
-                          method: Literal["embed"],
-                          **invoke_kwargs) -> JinaEmbeddingResponse:
+    async def embed_batched(self, text: str) -> list[float]:
         """
-        Return the response from the Jina API with retry logic for rate limits.
+        Embed a single text, coalescing it with the texts requested meanwhile by concurrent callers
+        (e.g. searches of different conversations): pending texts are sent in a single request once
+        `EMBED_MAX_BATCH` of them are collected or `EMBED_MAX_WAIT` seconds have passed.
 
-        Args:
-            method: The method to invoke, only "embed" for Jina.
-            *invoke_kwargs: Additional parameters for client methods invocation.
+        Parameters:
+            text (str): The text to embed.
 
         Returns:
-            JinaEmbeddingResponse: The response from the Jina AI embeddings endpoint.
+            list[float]: The embedding of the text.
         """
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._collect_embed_batches())
+        future = asyncio.get_running_loop().create_future()
+        self._batch_queue.put_nowait((text, future))
+        return await future
+
+    async def _collect_embed_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + EMBED_MAX_WAIT
+            while len(batch) < EMBED_MAX_BATCH and (timeout := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                except TimeoutError:
+                    break
+            # the request runs in its own task, so that the next batch is collected meanwhile
+            request = asyncio.create_task(self._send_embed_batch(batch))
+            self._batch_requests.add(request)
+            request.add_done_callback(self._batch_requests.discard)
+
+    async def _send_embed_batch(self, batch: list[tuple[str, asyncio.Future]]):
         try:
-            match method:
-                case "complete":
-                    raise NotImplementedError("Chat completion is not implemented for Jina.")
-                case "parse":
-                    raise NotImplementedError("Chat parsing is not implemented for Jina.")
-                case "embed":
-                    response = self._embed(**invoke_kwargs)
-                case _:
-                    raise ValueError(f"Invalid method: {method}. Use 'embed'.")
+            response = await self.ainvoke_with_retry('embed', texts=[text for text, _ in batch])
         except Exception as e:
-            try:
-                logger.warning(f"Retrying after error: {e}")
-                time.sleep(10)
-                return self.invoke_with_retry(method, **invoke_kwargs)
-            except Exception as retry_exception:
-                logger.error(f"Retry failed: {retry_exception}")
-                raise retry_exception
-        return response
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, response.data):
+            if not future.done():  # the caller may have been cancelled meanwhile
+                future.set_result(vector.embedding)
+
+    def close(self):
+        """
+        Close the pooled HTTP client.
+        """
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def aclose(self):
+        """
+        Close the async HTTP client, if it was ever created, and stop the micro-batching task.
+        """
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            self._batch_queue = self._batch_task = None
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+    def _complete(self, messages: list[dict], *args, **kwargs):
+        raise NotImplementedError("Chat completion is not implemented for Jina.")
+
+    def _parse(self, messages: list[dict], *args, **kwargs):
+        raise NotImplementedError("Chat parsing is not implemented for Jina.")
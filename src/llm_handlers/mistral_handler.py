@@ -1,27 +1,62 @@
+import asyncio
 import logging
 import os
-import time
-from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
 import mistralai
-from mistralai import Mistral, ChatCompletionResponse, EmbeddingResponse
+from mistralai import Mistral, ChatCompletionResponse, EmbeddingResponse, UsageInfo
 
-from llm_handlers.base_handler import BaseHandler
+from llm_handlers.base_handler import BaseHandler, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+MISTRAL_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, max_connections=32)
+
+
+def build_mistral_client(api_key: str | None = None) -> Mistral:
+    """
+    Build a Mistral client backed by long-lived HTTP/2 connection pools (sync and async),
+    so that consecutive calls reuse the same TCP/TLS connections.
+
+    Args:
+        api_key: Mistral API key, defaults to MISTRAL_API_KEY env variable.
+    """
+    return Mistral(
+        api_key=api_key or os.getenv("MISTRAL_API_KEY"),
+        client=httpx.Client(http2=True, limits=MISTRAL_HTTP_LIMITS),
+        async_client=httpx.AsyncClient(http2=True, limits=MISTRAL_HTTP_LIMITS),
+    )
+
 
 class MistralHandler(BaseHandler):
     """
     This class handles the interaction with the Mistral API for chat and embedding tasks.
     It provides methods to complete, parse, and embed messages, as well as to handle rate limits and token usage.
-    These methods are then invoked with retry logic in concrete method `invoke_with_retry`.
+    These methods are then invoked with retry logic in concrete method `invoke_with_retry`
+    (or `ainvoke_with_retry`, for their async versions on the async client).
     """
-    def __init__(self, chat_model: str = "mistral-small-latest", embed_model: str = "mistral-embed"):
+    def __init__(self, chat_model: str = "mistral-small-latest", embed_model: str = "mistral-embed",
+                 embed_batch_size: int = 128, embed_max_workers: int = 4, embed_max_batch_tokens: int = 16000,
+                 prewarm: bool = True):
         super().__init__(rps_limit=1, tpm_limit=500000)
         self.chat_model = chat_model
         self.embed_model = embed_model
-        self.client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+        self.embed_batch_size = embed_batch_size
+        # a batch never exceeds the TPM limit, otherwise it could never be sent within the rate limit
+        self.embed_max_batch_tokens = min(embed_max_batch_tokens, self.tpm_limit)
+        self.embed_max_workers = embed_max_workers
+        self.client = build_mistral_client()
+        if prewarm:
+            self.prewarm_connection(self.client.models.list)
+        self._embed_semaphore = asyncio.Semaphore(embed_max_workers)
+        self.async_methods = {
+            "complete": self._acomplete,
+            "parse": self._aparse,
+            "embed": self._aembed,
+        }
+        # embedding batches are rate limited and retried one by one
+        self.self_retrying_methods = frozenset({"embed"})
 
     def update_state(self, response: ChatCompletionResponse | EmbeddingResponse):
         """
@@ -31,11 +66,11 @@ class MistralHandler(BaseHandler):
             response (ChatCompletionResponse): The response from the Mistral API.
 
         """
-        self.token_usage['total_tokens'] += response.usage.total_tokens
-        self.token_usage['prompt_tokens'] += response.usage.prompt_tokens
-        self.token_usage['completion_tokens'] += response.usage.completion_tokens
-        request_time = time.time()
-        self.update_last_minute_state(request_time)
+        self.token_usage.total_tokens += response.usage.total_tokens
+        self.token_usage.prompt_tokens += response.usage.prompt_tokens
+        self.token_usage.completion_tokens += response.usage.completion_tokens
+        self.record_usage(response.usage)
+        self.consume_tokens(response.usage.total_tokens)
 
     def _complete(self, messages: list[dict], **chat_complete_kwargs) -> ChatCompletionResponse:
         response = self.client.chat.complete(
@@ -55,52 +90,108 @@ class MistralHandler(BaseHandler):
         self.update_state(response)
         return response
 
-    def _embed(self, messages: list[dict], **embeddings_create_kwargs) -> EmbeddingResponse:
-        if "to_embed_key" not in embeddings_create_kwargs:
-            raise ValueError("to_embed_key must be provided for embedding.")
-        to_embed_key = embeddings_create_kwargs.pop('to_embed_key')
-        sentences = [m.get(to_embed_key) for m in messages]
-        response = self.client.embeddings.create(
-            model=self.embed_model,
-            inputs=sentences,
-            **embeddings_create_kwargs
+    def _embed(self, texts: list[str], **embeddings_create_kwargs) -> EmbeddingResponse:
+        """
+        Embed texts sending them in batches of up to `embed_batch_size` inputs and (estimated)
+        `embed_max_batch_tokens` tokens per request, with up to `embed_max_workers` requests in flight at once.
+        Responses of multiple batches are merged in a single response, in the same order as input.
+        Duplicated texts are sent once.
+        """
+        # each batch takes its own rate limit slot and is retried on its own,
+        # so that a rate limited batch does not resend the others
+        def embed_batch(batch: list[str]) -> EmbeddingResponse:
+            return self.call_with_retry(
+                "embed", self.client.embeddings.create, sum(map(estimate_tokens, batch)),
+                model=self.embed_model, inputs=batch, **embeddings_create_kwargs,
+            )
+
+        unique_texts, text_positions = self.dedupe_texts(texts)
+        batches = self._pack_batches(unique_texts)
+        if len(batches) <= 1:
+            responses = [embed_batch(unique_texts)]
+        else:
+            with ThreadPoolExecutor(max_workers=self.embed_max_workers) as executor:
+                # map preserves the order of the batches
+                responses = list(executor.map(embed_batch, batches))
+        return self._finalize_embedding_responses(responses, texts, unique_texts, text_positions)
+
+    async def _acomplete(self, messages: list[dict], **chat_complete_kwargs) -> ChatCompletionResponse:
+        response = await self.client.chat.complete_async(
+            model=self.chat_model,
+            messages=messages,
+            **chat_complete_kwargs
         )
         self.update_state(response)
         return response
 
-    def invoke_with_retry(self,
-                          method: Literal["complete", "parse", "embed"],
-                          **invoke_kwargs) -> ChatCompletionResponse | EmbeddingResponse:
+    async def _aparse(self, messages: list[dict], **chat_parse_kwargs) -> ChatCompletionResponse:
+        response = await self.client.chat.parse_async(
+            model=self.chat_model,
+            messages=messages,
+            **chat_parse_kwargs
+        )
+        self.update_state(response)
+        return response
+
+    async def _aembed(self, texts: list[str], **embeddings_create_kwargs) -> EmbeddingResponse:
+        """
+        Async version of `_embed`: batches are sent concurrently on the async client,
+        with up to `embed_max_workers` requests in flight at once.
         """
-        Return the response from the Mistral API with retry logic for rate limits.
+        async def embed_batch(batch: list[str]) -> EmbeddingResponse:
+            async with self._embed_semaphore:
+                return await self.acall_with_retry(
+                    "embed", self.client.embeddings.create_async, sum(map(estimate_tokens, batch)),
+                    model=self.embed_model, inputs=batch, **embeddings_create_kwargs,
+                )
 
-        Args:
-            method: The method to invoke, either "complete", "parse" or "embed".
-            messages: List of message dictionaries.
-            *invoke_kwargs: Additional parameters for client methods invocation.
+        unique_texts, text_positions = self.dedupe_texts(texts)
+        batches = self._pack_batches(unique_texts) or [unique_texts]
+        # gather preserves the order of the batches
+        responses = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+        return self._finalize_embedding_responses(responses, texts, unique_texts, text_positions)
 
-        Returns:
-            ChatCompletionResponse: The response from the chat completion.
+    def _finalize_embedding_responses(self, responses: list[EmbeddingResponse], texts: list[str],
+                                      unique_texts: list[str], text_positions: list[int]) -> EmbeddingResponse:
         """
-        self.wait_if_rps_limit()
-        try:
-            if method == "complete":
-                response = self._complete(**invoke_kwargs)
-            elif method == "parse":
-                response = self._parse(**invoke_kwargs)
-            elif method == "embed":
-                response = self._embed(**invoke_kwargs)
-            else:
-                raise ValueError(f"Unknown method: {method}")
-        except Exception as e:
-            logger.warning(f'method {method} failed. Try again (waiting if TPM limit). Current error: {e}')
-            self.wait_if_tpm_limit()
-            try:
-                logger.debug('second invocation (after tpm or not')
-                response = self.invoke_with_retry(method, **invoke_kwargs)
-            except Exception as retry_exception:
-                # try and raise again the error in case it was not a problem of TPM
-                logger.error(f"Retry failed: {retry_exception}")
-                raise retry_exception
+        Merge the responses of the batches of a deduplicated embedding request, update the handler state
+        and expand the embeddings back to the original texts.
+        """
+        response = responses[0] if len(responses) == 1 else self._merge_embedding_responses(responses)
+        self.update_state(response)
+        if len(unique_texts) < len(texts):
+            # duplicated texts share the embedding of their unique text
+            data = [response.data[p].model_copy(update={'index': i}) for i, p in enumerate(text_positions)]
+            response = response.model_copy(update={'data': data})
         return response
 
+    def _pack_batches(self, texts: list[str]) -> list[list[str]]:
+        """
+        Greedily pack texts, in order, into batches bounded by both `embed_batch_size` inputs
+        and `embed_max_batch_tokens` estimated tokens (a longer text gets a batch on its own).
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if batch and (len(batch) == self.embed_batch_size or batch_tokens + tokens > self.embed_max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _merge_embedding_responses(responses: list[EmbeddingResponse]) -> EmbeddingResponse:
+        data = []
+        for response in responses:
+            # indices of each response restart from 0, they are shifted to the position in the whole input
+            offset = len(data)
+            data.extend(vector.model_copy(update={'index': offset + i}) for i, vector in enumerate(response.data))
+        usage = UsageInfo(
+            prompt_tokens=sum(r.usage.prompt_tokens for r in responses),
+            completion_tokens=sum(r.usage.completion_tokens for r in responses),
+            total_tokens=sum(r.usage.total_tokens for r in responses),
+        )
+        return responses[0].model_copy(update={'data': data, 'usage': usage})
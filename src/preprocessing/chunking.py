@@ -1,13 +1,25 @@
+import base64
 import logging
+import math
 import re
+from typing import Iterable, TYPE_CHECKING
 
-from mistralai import OCRResponse
-from pydantic import BaseModel, Field
+import numpy as np
+from pydantic import BaseModel, Field, field_serializer, field_validator
 
 from qdrant_client.models import PointStruct
 
+if TYPE_CHECKING:
+    # only needed for annotations: importing the whole mistralai SDK is not required to chunk markdown
+    from mistralai import OCRResponse
+
 logger = logging.getLogger(__name__)
 
+# lines made only of a line terminator, skipped when building chunks
+_BLANK_LINES = ('\n', '\r\n')
+# markdown header lines of OCR pages
+_HEADER_LINE_RE = re.compile(r"(^(#{1,6}) .*?$)", re.MULTILINE)
+
 
 class Chunk(BaseModel):
     id: int = Field(..., description="The ID of the chunk")
@@ -19,10 +31,32 @@ class Chunk(BaseModel):
 class ChunkWithEmbedding(Chunk):
     embedding: list[float] | None = Field(..., description="The embedding of the chunk")
 
+    @field_validator('embedding', mode='before')
+    @classmethod
+    def decode_embedding(cls, embedding):
+        """
+        Accept embeddings serialized as base64 of float16 bytes, besides plain lists of floats.
+        """
+        if isinstance(embedding, str):
+            return np.frombuffer(base64.b64decode(embedding), dtype=np.float16).astype(np.float32).tolist()
+        return embedding
+
+    @field_serializer('embedding', when_used='json')
+    def encode_embedding(self, embedding: list[float] | None) -> str | None:
+        """
+        Serialize the embedding to JSON as base64 of float16 bytes: 2 bytes per element
+        instead of ~20 characters for a float64 literal.
+        """
+        if embedding is None:
+            return None
+        return base64.b64encode(np.asarray(embedding, dtype=np.float16).tobytes()).decode('ascii')
+
     @classmethod
     def from_json_elem(cls, json_elem: dict) -> "ChunkWithEmbedding":
         """
         Convert a JSON dictionaries toa ChunkWithEmbedding object.
+        JSON files of embeddings are written by this package, hence validation is skipped
+        and only the embedding is decoded.
 
         Args:
             json_elem (dict): The JSON dictionary to convert.
@@ -30,11 +64,12 @@ class ChunkWithEmbedding(Chunk):
         Returns:
             ChunkWithEmbedding: The converted ChunkWithEmbedding object.
         """
-        return cls(**json_elem)
+        return cls.model_construct(**{**json_elem, 'embedding': cls.decode_embedding(json_elem.get('embedding'))})
 
     def to_qdrant_point_struct(self, **file_metadata_kwargs) -> PointStruct:
         """
         Convert the ChunkWithEmbedding object to a Qdrant PointStruct.
+        Chunks are trusted in-process data, hence the PointStruct is built without validation.
 
         Parameters:
             **file_metadata_kwargs: Additional metadata to include in the payload.
@@ -42,7 +77,7 @@ class ChunkWithEmbedding(Chunk):
         Returns:
             PointStruct: The Qdrant PointStruct object.
         """
-        return PointStruct(
+        return PointStruct.model_construct(
             id=self.id,
             vector=self.embedding,
             payload={
@@ -52,15 +87,14 @@ class ChunkWithEmbedding(Chunk):
         )
 
 
-
-def split_markdown_into_chunks(lines: list[str]) -> list[Chunk]:
+def split_markdown_into_chunks(lines: Iterable[str]) -> list[Chunk]:
     """
     Split a list of lines from a Markdown file into chunks based on headers.
     Each chunk will contain all lines up to the next header, and headers will be
     included in the chunk as prefixes.
 
     Parameters:
-        lines (list): List of lines from a Markdown file.
+        lines (Iterable[str]): Lines from a Markdown file, e.g. a list or an open text file.
 
     Returns:
         list: List of strings, where each string is a chunk of Markdown text.
@@ -68,86 +102,167 @@ def split_markdown_into_chunks(lines: list[str]) -> list[Chunk]:
     chunks = []
     current_chunk_lines = []
     header_stack = []
-    header_pattern = re.compile(r'^(#+)\s+(.*)$')
+    # header_prefixes[i] caches the '\n'-joined headers header_stack[:i+1], updated in lockstep with header_stack
+    header_prefixes = []
 
     def start_new_chunk():
+        # chunks are built directly, without an intermediate list of strings; the buffer is reused with clear(),
+        # which measured on par with rebinding a new list
         if current_chunk_lines:
-            chunks.append(''.join(current_chunk_lines))
+            chunks.append(Chunk(id=len(chunks), text=''.join(current_chunk_lines)))
             current_chunk_lines.clear()
 
     for line in lines:
-        # check if the line is a header
-        match = header_pattern.match(line)
-        if match:
+        # check if the line is a header, i.e. one or more '#' followed by whitespace (as regex `^(#+)\s+(.*)$`)
+        # plain string inspection is used instead of a regex match, since this runs on every line
+        level = 0
+        if line[:1] == '#':
+            level = len(line) - len(line.lstrip('#'))
+            if level == len(line) or not line[level].isspace():
+                level = 0
+        if level:
             start_new_chunk()  # store all previous lines whe a new header is found
-            level = len(match.group(1))
-            text = match.group(2)
+            text = line[level:].lstrip().removesuffix('\n')
             while header_stack and header_stack[-1][0] >= level:
                 header_stack.pop()
+                header_prefixes.pop()
+            # prefix made of all parent headers, taken from the cached prefix of the parent header
+            prefix = (header_prefixes[-1] if header_prefixes else '') + '\n'
+            header = "#" * level + " " + text
+            header_prefixes.append(prefix + header if header_prefixes else header)
             header_stack.append((level, text))
-            prefix = '\n'.join(["#" * h[0] + " " + h[1] for h in header_stack[:-1]]) + '\n'
             current_chunk_lines.append(prefix)
-        if line not in ['\n', '\r\n']:
+        if line not in _BLANK_LINES:
             # update list of lines in current chunk (will be stored as chunk when a new header is found)
             current_chunk_lines.append(line)
 
     start_new_chunk()  # Add a last chunk with the remaining current lines from last iteration
-    chunks_list = [Chunk(id=i, text=c) for i, c in enumerate(chunks)]
-    return chunks_list
+    return chunks
+
+
+def _last_header(md: str) -> re.Match | None:
+    """
+    Return the match of the last header line of a markdown text, if any.
+    Header lines are scanned once, instead of asserting with a lookahead that no header follows each candidate,
+    which rescans the rest of the text for every header (quadratic on long pages).
+    """
+    last_match = None
+    for last_match in _HEADER_LINE_RE.finditer(md):
+        pass
+    return last_match
+
+
+def _split_text(md: str, max_chars: int) -> list[str]:
+    """
+    Split a text in a single pass into the fewest pieces of at most `max_chars` characters, of about the same size:
+    each piece targets the remaining length divided by the number of pieces still needed, and is cut after
+    the last newline in the second half of its target size (hard cut if there is none).
+
+    Parameters:
+        md (str): The text to split.
+        max_chars (int): The max number of characters of a piece.
+
+    Returns:
+        list[str]: The pieces of the text.
+    """
+    pieces = []
+    start = 0
+    while len(md) - start > max_chars:
+        remaining = len(md) - start
+        target = math.ceil(remaining / math.ceil(remaining / max_chars))
+        end = start + target
+        cut = md.rfind('\n', start + target // 2, end) + 1
+        if cut <= 0:
+            cut = end
+        pieces.append(md[start:cut])
+        start = cut
+    pieces.append(md[start:])
+    return pieces
+
+
+def _join_page_parts(parts: list[str], max_chars: int = 20000) -> list[str]:
+    """
+    Join the parts of a page chunk (page text and overlaps), splitting it at newlines if it is too long
+    (see `_split_text`). The length is computed from the parts before joining them, so that pages fitting
+    in a chunk are joined once and only longer pages are split.
+
+    Parameters:
+        parts (list[str]): The parts of the page chunk.
+        max_chars (int): The max number of characters of a chunk.
+            TODO make this a parameter depending on a tokenizer and MAX_TOKENS
 
+    Returns:
+        list[str]: The page chunk, or its pieces.
+    """
+    if sum(map(len, parts)) <= max_chars:
+        return ["".join(parts)]
+    return _split_text("".join(parts), max_chars)
 
-def add_header_overlap_to_chunks(ocr_response: OCRResponse) -> list[Chunk]:
-    LAST_HEADER_REGEX = r"(^(#{1,6}) .*?$)(?![\s\S]*^#{1,6} .*?$)"
-    FIRST_HEADER_REGEX = r"(^(#{1,6}) .*?$)"
 
-    idx = 0
+def _index_pages(ocr_response: "OCRResponse") -> tuple[list[str], list[re.Match | None], list[re.Match | None]]:
+    """
+    Pre-pass over the OCR pages, searching the headers of each page once: parallel lists of
+    the markdown, the first header match and the last header match of each page.
+    """
+    markdowns = [page.markdown for page in ocr_response.pages]
+    first_headers = [_HEADER_LINE_RE.search(md) for md in markdowns]
+    last_headers = [_last_header(md) if first_header else None for md, first_header in zip(markdowns, first_headers)]
+    return markdowns, first_headers, last_headers
+
+
+def add_header_overlap_to_chunks(ocr_response: "OCRResponse") -> list[Chunk]:
+    markdowns, first_headers, last_headers = _index_pages(ocr_response)
     chunks = []
-    for i, page in enumerate(ocr_response.pages):
-        current_md = page.markdown
+    for i, current_md in enumerate(markdowns):
+        parts = [current_md]
 
         # add previous and next header text to current chunk for further context
 
         if i > 0:  # skip for first page
-            # search last header level from previous page and, if present, add text after current chunk
-            previous_md = ocr_response.pages[i - 1].markdown
-            previous_last_header_match = re.search(LAST_HEADER_REGEX, previous_md, re.MULTILINE)
+            # last header level from previous page and, if present, add text after current chunk
+            previous_last_header_match = last_headers[i - 1]
             if previous_last_header_match:
-                current_md += "<\br>PAGE_BREAK<\br>" + previous_md[previous_last_header_match.start():]
+                parts += ["<\br>PAGE_BREAK<\br>", markdowns[i - 1][previous_last_header_match.start():]]
 
-        if i < len(ocr_response.pages) - 1:  # skip for last page
-            # search first header level from next page and, if present, add text before current chunk
-            next_md = ocr_response.pages[i + 1].markdown
-            next_first_header_match = re.search(FIRST_HEADER_REGEX, next_md, re.MULTILINE)
+        if i < len(markdowns) - 1:  # skip for last page
+            # first header level from next page and, if present, add text before current chunk
+            next_first_header_match = first_headers[i + 1]
             if next_first_header_match:
-                current_md += "\n\n<\br>PAGE_BREAK<\br>\n\n" + next_md[:next_first_header_match.start()]
-
-        # split if current page is too long
-        if len(current_md) > 20000:  # TODO make this a parameter depending on a tokenizer and MAX_TOKENS
-            split_idx = len(current_md) // 2  # simple split using half of the text
-            current_md_start = current_md[:split_idx]
-            current_md_end = current_md[split_idx:]
-            chunks.append(Chunk(id=idx, text=current_md_start))
-            chunks.append(Chunk(id=idx+1, text=current_md_end))
-        else:
-            chunks.append(Chunk(id=idx, text=current_md))
-        idx += 1
+                parts += ["\n\n<\br>PAGE_BREAK<\br>\n\n", markdowns[i + 1][:next_first_header_match.start()]]
+
+        # ids are sequential over all chunks, pieces of a split page included
+        for text in _join_page_parts(parts):
+            chunks.append(Chunk(id=len(chunks), text=text))
 
     return chunks
 
 
-def split_chunks_using_prev_headers(ocr_response: OCRResponse) -> list[Chunk]:
-    chunks = []
+def _last_header_in_parts(parts: list[str]) -> tuple[int, re.Match] | tuple[None, None]:
+    """
+    Return the index of the part holding the last header line of a chunk built as a list of parts, and its match.
+    Parts always start at the beginning of a line, hence headers never span two parts.
+    """
+    for k in range(len(parts) - 1, -1, -1):
+        if (match := _last_header(parts[k])) is not None:
+            return k, match
+    return None, None
+
+
+def split_chunks_using_prev_headers(ocr_response: "OCRResponse") -> list[Chunk]:
+    # chunks are accumulated as lists of parts and joined once at the end, instead of being concatenated
+    # (hence copied) at every page
+    chunk_ids = []
+    chunk_parts = []
     for i, page in enumerate(ocr_response.pages):
         if i == 0:
-            chunks.append(Chunk(id=i, text=page.markdown))
+            chunk_ids.append(i)
+            chunk_parts.append([page.markdown])
         else:
-            last_header_regex = r"(^(#{1,6}) .*?$)(?![\s\S]*^#{1,6} .*?$)"
-            first_header_regex = r"(^(#{1,6}) .*?$)"
             # take last header level from previous page and the first header level in the current page
             # we use 100 as default for a very inner subparagraph
-            previous_md = chunks[-1].text
+            previous_parts = chunk_parts[-1]
             current_md = page.markdown
-            previous_last_header_match = re.search(last_header_regex, previous_md, re.MULTILINE)
+            last_header_part, previous_last_header_match = _last_header_in_parts(previous_parts)
             if previous_last_header_match:
                 previous_last_header_level = len(previous_last_header_match.group(2))
                 logger.debug(f'previous page last header: "{previous_last_header_match.group(1)}"')
@@ -155,7 +270,7 @@ def split_chunks_using_prev_headers(ocr_response: OCRResponse) -> list[Chunk]:
                 previous_last_header_level = 100
                 logger.debug('previous page has no header')
 
-            current_first_header_match = re.search(first_header_regex, current_md, re.MULTILINE)
+            current_first_header_match = _HEADER_LINE_RE.search(current_md)
             if current_first_header_match:
                 current_first_header_level = len(current_first_header_match.group(2))
                 logger.debug(f'current page first header: "{current_first_header_match.group(1)}"')
@@ -170,48 +285,49 @@ def split_chunks_using_prev_headers(ocr_response: OCRResponse) -> list[Chunk]:
                                                 :current_first_header_match.start()] if current_first_header_match else current_md
                 text_after_curr_first_header = current_md[
                                                current_first_header_match.start():] if current_first_header_match else ""
-                chunks[-1].text += "\n" + text_before_curr_first_header
+                previous_parts.extend(("\n", text_before_curr_first_header))
                 if text_after_curr_first_header:
-                    chunks.append(Chunk(id=i, text=text_after_curr_first_header))
+                    chunk_ids.append(i)
+                    chunk_parts.append([text_after_curr_first_header])
             # otherwise if last header in previous page is > first header in current page (e.g. ### vs ##) (=prev is less important)
             # then we split previous page and add text after last header in previous page to current page/chunk
             elif previous_last_header_level > current_first_header_level:
-                text_before_prev_last_header = previous_md[
-                                               :previous_last_header_match.start()] if previous_last_header_match else previous_md
-                text_after_prev_last_header = previous_md[
-                                              previous_last_header_match.start():] if previous_last_header_match else ""
-                chunks[-1].text = text_before_prev_last_header
-                chunks.append(Chunk(id=i, text=current_md + "\n" + text_after_prev_last_header))
+                if previous_last_header_match:
+                    header_start = previous_last_header_match.start()
+                    header_part = previous_parts[last_header_part]
+                    text_after_prev_last_header = [header_part[header_start:], *previous_parts[last_header_part + 1:]]
+                    del previous_parts[last_header_part:]
+                    previous_parts.append(header_part[:header_start])
+                else:
+                    text_after_prev_last_header = []
+                chunk_ids.append(i)
+                chunk_parts.append([current_md, "\n", *text_after_prev_last_header])
             else:
                 # if both levels are equals we add the text of the current page to the last chunk
-                chunks[-1].text += "\n" + current_md
+                previous_parts.extend(("\n", current_md))
+
+    return [Chunk(id=chunk_id, text="".join(parts)) for chunk_id, parts in zip(chunk_ids, chunk_parts)]
 
 
-def add_overlap_to_chunks(ocr_response: OCRResponse) -> list[Chunk]:
-    idx = 0
+def add_overlap_to_chunks(ocr_response: "OCRResponse") -> list[Chunk]:
     overlap_chars = 1000
     chunks = []
-    for i, page in enumerate(ocr_response.pages):
-        current_md = page.markdown
+    markdowns = [page.markdown for page in ocr_response.pages]
+    # overlaps are the last / first `overlap_chars` characters of the previous / next page
+    heads = [md[:overlap_chars] for md in markdowns]
+    tails = [md[-overlap_chars:] for md in markdowns]
+    for i, current_md in enumerate(markdowns):
+        parts = [current_md]
 
         # add previous page overlap to current for further context
         if i > 0:  # skip for first page
-            previous_text = ocr_response.pages[i - 1].markdown[overlap_chars:]
-            current_md = "\n\n..." + previous_text + "<\br>PAGE_BREAK<\br>" + current_md
+            parts[:0] = ["\n\n...", tails[i - 1], "<\br>PAGE_BREAK<\br>"]
 
-        if i < len(ocr_response.pages) - 1:  # skip for last page
+        if i < len(markdowns) - 1:  # skip for last page
             # add next page overlap to current for further context
-            next_md = ocr_response.pages[i + 1].markdown[:overlap_chars]
-            current_md += "\n\n<\br>PAGE_BREAK<\br>\n\n" + next_md + "...\n\n"
-
-        # split if current page is too long
-        if len(current_md) > 20000:  # TODO make this a parameter depending on a tokenizer and MAX_TOKENS
-            split_idx = len(current_md) // 2  # simple split using half of the text
-            current_md_start = current_md[:split_idx]
-            current_md_end = current_md[split_idx:]
-            chunks.append(Chunk(id=idx, text=current_md_start))
-            chunks.append(Chunk(id=idx + 1, text=current_md_end))
-        else:
-            chunks.append(Chunk(id=idx, text=current_md))
-        idx += 1
+            parts += ["\n\n<\br>PAGE_BREAK<\br>\n\n", heads[i + 1], "...\n\n"]
+
+        # ids are sequential over all chunks, pieces of a split page included
+        for text in _join_page_parts(parts):
+            chunks.append(Chunk(id=len(chunks), text=text))
     return chunks
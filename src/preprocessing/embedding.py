@@ -0,0 +1,312 @@
+import asyncio
+import itertools
+import logging
+from typing import Iterable, Iterator
+
+from pydantic_core import from_json
+from qdrant_client import QdrantClient
+from qdrant_client.models import (Batch, Distance, OptimizersConfigDiff, ScalarQuantization, ScalarQuantizationConfig,
+                                  ScalarType, VectorParams)
+
+from llm_handlers.base_handler import BaseHandler
+from llm_handlers.jina_handler import JinaHandler
+from preprocessing.chunking import Chunk, ChunkWithEmbedding
+from utils.cache import EmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_SIZE = 64
+# int8 scalar quantization keeps a 4x smaller copy of the vectors in RAM for search,
+# original vectors are used for rescoring
+QDRANT_QUANTIZATION_CONFIG = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+)
+# Qdrant server default, restored after bulk loads into collections created without an explicit threshold
+QDRANT_DEFAULT_INDEXING_THRESHOLD = 20000
+
+
+def _split_cached(embeddings_handler: BaseHandler, batch: tuple[Chunk, ...],
+                  cache: EmbeddingCache | None) -> tuple[list[list[float] | None], list[str]]:
+    """
+    Look up the embeddings of a batch of chunks in the cache, returning them (None on miss)
+    together with the texts still to embed.
+    """
+    texts = [c.text for c in batch]
+    if cache is None:
+        return [None] * len(batch), texts
+    vectors = cache.get_many(embeddings_handler.embed_model, texts)
+    return vectors, [text for text, vector in zip(texts, vectors) if vector is None]
+
+
+def _merge_cached(embeddings_handler: BaseHandler, batch: tuple[Chunk, ...], vectors: list[list[float] | None],
+                  missing_texts: list[str], emb_resp, cache: EmbeddingCache | None) -> list[ChunkWithEmbedding]:
+    """
+    Fill the cache misses of a batch with the embedding response of the missing texts (storing them in the cache)
+    and build the chunks with embeddings.
+    """
+    missing_vectors = [vector.embedding for vector in emb_resp.data] if emb_resp is not None else []
+    if cache is not None and missing_texts:
+        cache.set_many(embeddings_handler.embed_model, missing_texts, missing_vectors)
+    missing = iter(missing_vectors)
+    # chunks and embedding responses are already validated, no need to validate them again
+    return [ChunkWithEmbedding.model_construct(id=chunk.id, text=chunk.text,
+                                               embedding=vector if vector is not None else next(missing))
+            for chunk, vector in zip(batch, vectors)]
+
+
+def embed_chunks(embeddings_handler: BaseHandler, chunks: list[Chunk],
+                 batch_size: int = EMBED_BATCH_SIZE, cache: EmbeddingCache | None = None) -> list[ChunkWithEmbedding]:
+    """
+    Embed chunks sending them in batches, so that each request carries up to `batch_size` chunks
+    instead of paying one round-trip per chunk.
+
+    Parameters:
+        embeddings_handler (BaseHandler): The handler used to invoke the embedding model.
+        chunks (list[Chunk]): The chunks to embed.
+        batch_size (int): The maximum number of chunks sent in a single embedding request.
+        cache (EmbeddingCache | None): The cache of already computed embeddings, if any:
+            only the chunks missing from the cache are sent to the embedding model.
+
+    Returns:
+        list[ChunkWithEmbedding]: The chunks with their embeddings, in the same order as input.
+    """
+    chunks_with_embeddings = []
+    for batch in itertools.batched(chunks, batch_size):
+        vectors, missing_texts = _split_cached(embeddings_handler, batch, cache)
+        emb_resp = None
+        if missing_texts:
+            logger.info(f'Embedding {len(missing_texts)} chunks in {batch[0].id:02}-{batch[-1].id:02} '
+                        f'with {sum(len(t) for t in missing_texts)} characters')
+            emb_resp = embeddings_handler.invoke_with_retry("embed", texts=missing_texts)
+        chunks_with_embeddings.extend(_merge_cached(embeddings_handler, batch, vectors, missing_texts, emb_resp, cache))
+    return chunks_with_embeddings
+
+
+def to_qdrant_batch(chunks: list[ChunkWithEmbedding], **file_metadata_kwargs) -> Batch:
+    """
+    Convert chunks with embeddings to a column-wise Qdrant Batch, avoiding the construction
+    (and validation) of a PointStruct model for each chunk.
+
+    Parameters:
+        chunks (list[ChunkWithEmbedding]): The chunks to convert.
+        **file_metadata_kwargs: Additional metadata to include in the points payload.
+
+    Returns:
+        Batch: The Qdrant Batch with ids, vectors and payloads of the chunks.
+    """
+    return Batch(
+        ids=[chunk.id for chunk in chunks],
+        vectors=[chunk.embedding for chunk in chunks],
+        payloads=[{"text": chunk.text, **file_metadata_kwargs} for chunk in chunks],
+    )
+
+
+def wait_for_pending_updates(vector_db: QdrantClient, collection_name: str):
+    """
+    Block until all previous updates of a collection are applied. Qdrant applies updates in order,
+    hence an empty upsert with `wait=True` completes only after all the previous updates sent with `wait=False`.
+
+    Parameters:
+        vector_db (QdrantClient): The Qdrant client.
+        collection_name (str): The Qdrant collection.
+    """
+    vector_db.upsert(collection_name=collection_name, points=[], wait=True)
+
+
+def dump_chunks_with_embeddings(file_path: str, chunks: Iterable[ChunkWithEmbedding]):
+    """
+    Save chunks with embeddings to a JSON Lines file, one chunk per line,
+    so that the file can be read back as a stream.
+
+    Parameters:
+        file_path (str): Path to the JSON Lines file.
+        chunks (Iterable[ChunkWithEmbedding]): The chunks to save.
+    """
+    with open(file_path, "w", encoding="utf-8") as jsonl_file:
+        for chunk in chunks:
+            jsonl_file.write(chunk.model_dump_json() + "\n")
+
+
+def iter_chunks_with_embeddings(file_path: str) -> Iterator[ChunkWithEmbedding]:
+    """
+    Lazily load chunks with embeddings from a JSON Lines file written by `dump_chunks_with_embeddings`,
+    keeping a single chunk in memory at a time. Files with `.json` extension are read as a JSON array,
+    as written by previous versions.
+
+    Parameters:
+        file_path (str): Path to the JSON Lines (or JSON) file.
+
+    Returns:
+        Iterator[ChunkWithEmbedding]: The loaded chunks.
+    """
+    with open(file_path, "rb") as json_file:
+        if file_path.endswith(".json"):
+            yield from (ChunkWithEmbedding.from_json_elem(elem) for elem in from_json(json_file.read()))
+            return
+        for line in json_file:
+            if line.strip():
+                yield ChunkWithEmbedding.from_json_elem(from_json(line))
+
+
+async def _aembed_batch(embeddings_handler: JinaHandler, batch: tuple[Chunk, ...],
+                        cache: EmbeddingCache | None = None) -> list[ChunkWithEmbedding]:
+    vectors, missing_texts = _split_cached(embeddings_handler, batch, cache)
+    emb_resp = None
+    if missing_texts:
+        logger.info(f'Embedding {len(missing_texts)} chunks in {batch[0].id:02}-{batch[-1].id:02} '
+                    f'with {sum(len(t) for t in missing_texts)} characters')
+        emb_resp = await embeddings_handler.ainvoke_with_retry("embed", texts=missing_texts)
+    return _merge_cached(embeddings_handler, batch, vectors, missing_texts, emb_resp, cache)
+
+
+async def aembed_chunks(embeddings_handler: JinaHandler, chunks: list[Chunk],
+                        batch_size: int = EMBED_BATCH_SIZE, cache: EmbeddingCache | None = None) -> list[ChunkWithEmbedding]:
+    """
+    Embed chunks in batches, sending all batches concurrently. Concurrency and pacing
+    are bounded by the handler, so that provider rate limits are respected.
+
+    Parameters:
+        embeddings_handler (JinaHandler): The handler used to invoke the embedding model.
+        chunks (list[Chunk]): The chunks to embed.
+        batch_size (int): The maximum number of chunks sent in a single embedding request.
+        cache (EmbeddingCache | None): The cache of already computed embeddings, if any.
+
+    Returns:
+        list[ChunkWithEmbedding]: The chunks with their embeddings, in the same order as input.
+    """
+    batches = list(itertools.batched(chunks, batch_size))
+    try:
+        # gather preserves the order of the batches
+        embedded_batches = await asyncio.gather(*[_aembed_batch(embeddings_handler, batch, cache) for batch in batches])
+    finally:
+        await embeddings_handler.aclose()
+    return [chunk for batch in embedded_batches for chunk in batch]
+
+
+async def aembed_and_upsert_chunks(embeddings_handler: JinaHandler, chunks: list[Chunk],
+                                   vector_db: QdrantClient, collection_name: str,
+                                   batch_size: int = 32, create_collection: bool = True,
+                                   embeddings_file: str | None = None, cache: EmbeddingCache | None = None,
+                                   **file_metadata_kwargs) -> list[ChunkWithEmbedding]:
+    """
+    Pipeline embedding chunks and loading them in Qdrant: while a batch is being embedded,
+    already embedded batches are upserted (and optionally appended to a JSON Lines file),
+    so that the network I/O of the two services and the disk I/O overlap.
+
+    Parameters:
+        embeddings_handler (JinaHandler): The handler used to invoke the embedding model.
+        chunks (list[Chunk]): The chunks to embed.
+        vector_db (QdrantClient): The Qdrant client used for upserts
+            (it is invoked from worker threads, hence local clients must disable the same-thread check).
+        collection_name (str): The Qdrant collection receiving the points.
+        batch_size (int): The maximum number of chunks sent in a single embedding request.
+        create_collection (bool): Whether to create the collection, sized on the first embedded batch.
+        embeddings_file (str | None): Path of the JSON Lines file where chunks with embeddings are saved
+            as soon as they are embedded (see `dump_chunks_with_embeddings`), if any.
+        cache (EmbeddingCache | None): The cache of already computed embeddings, if any.
+        **file_metadata_kwargs: Additional metadata to include in the points payload.
+
+    Returns:
+        list[ChunkWithEmbedding]: The chunks with their embeddings, in the same order as input.
+    """
+    batches = list(itertools.batched(chunks, batch_size))
+    upsert_queue: asyncio.Queue[list[ChunkWithEmbedding] | None] = asyncio.Queue(maxsize=8)
+    write_queue: asyncio.Queue[list[ChunkWithEmbedding] | None] = asyncio.Queue(maxsize=8)
+    queues = [upsert_queue, write_queue] if embeddings_file else [upsert_queue]
+    chunks_with_embeddings: list[ChunkWithEmbedding] = []
+
+    async def embed_worker():
+        # batches are embedded concurrently and queued to every consumer as soon as each one is ready
+        tasks = [asyncio.create_task(_aembed_batch(embeddings_handler, batch, cache)) for batch in batches]
+        try:
+            for task in asyncio.as_completed(tasks):
+                embedded_batch = await task
+                for queue in queues:
+                    await queue.put(embedded_batch)
+        except BaseException:
+            # no more embedding requests once the pipeline fails (or is cancelled)
+            for task in tasks:
+                task.cancel()
+            raise
+        # consumers stop at the end of the queue; on errors they are cancelled instead,
+        # since a full queue would block the sentinel
+        for queue in queues:
+            await queue.put(None)
+
+    async def upsert_worker():
+        collection_ready = not create_collection
+        while (embedded_batch := await upsert_queue.get()) is not None:
+            if not collection_ready:
+                await asyncio.to_thread(
+                    vector_db.create_collection,
+                    collection_name=collection_name,
+                    vectors_config=VectorParams(size=len(embedded_batch[0].embedding), distance=Distance.COSINE),
+                    quantization_config=QDRANT_QUANTIZATION_CONFIG,
+                )
+                logger.info(f"Collection '{collection_name}' created successfully")
+                collection_ready = True
+            points = to_qdrant_batch(embedded_batch, **file_metadata_kwargs)
+            # upserts are not awaited on the server side, a single wait is done once all batches are sent
+            operation_info = await asyncio.to_thread(vector_db.upsert, collection_name=collection_name,
+                                                     wait=False, points=points)
+            logger.debug(f"upsert of {len(embedded_batch)} points: {operation_info}")
+            chunks_with_embeddings.extend(embedded_batch)
+        if collection_ready:
+            await asyncio.to_thread(wait_for_pending_updates, vector_db, collection_name)
+
+    async def write_worker():
+        logger.info(f"Saving chunks with embeddings to {embeddings_file}")
+        with open(embeddings_file, "w", encoding="utf-8") as jsonl_file:
+            while (embedded_batch := await write_queue.get()) is not None:
+                await asyncio.to_thread(jsonl_file.writelines, [c.model_dump_json() + "\n" for c in embedded_batch])
+
+    workers = [asyncio.create_task(worker())
+               for worker in [embed_worker, upsert_worker] + ([write_worker] if embeddings_file else [])]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # gather does not cancel the other workers when one fails: the producer would keep calling the API
+        # and the consumers would wait forever on their queues
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        await embeddings_handler.aclose()
+    return sorted(chunks_with_embeddings, key=lambda c: c.id)
+
+
+def upload_chunks(vector_db: QdrantClient, collection_name: str, chunks: Iterable[ChunkWithEmbedding],
+                  batch_size: int = 256, parallel: int = 8, **file_metadata_kwargs):
+    """
+    Bulk load chunks with embeddings in a Qdrant collection: points are sent in batches by `parallel` workers,
+    while HNSW indexing is disabled, so that the index is built once at the end instead of during inserts.
+
+    Parameters:
+        vector_db (QdrantClient): The Qdrant client.
+        collection_name (str): The Qdrant collection receiving the points.
+        chunks (Iterable[ChunkWithEmbedding]): The chunks to load, possibly a lazy iterator.
+        batch_size (int): The number of points sent in a single request.
+        parallel (int): The number of upload workers (ignored by local Qdrant clients).
+        **file_metadata_kwargs: Additional metadata to include in the points payload.
+    """
+    indexing_threshold = vector_db.get_collection(collection_name).config.optimizer_config.indexing_threshold
+    if indexing_threshold is None:
+        # a None threshold in the diff would leave indexing disabled
+        indexing_threshold = QDRANT_DEFAULT_INDEXING_THRESHOLD
+    vector_db.update_collection(collection_name=collection_name,
+                                optimizer_config=OptimizersConfigDiff(indexing_threshold=0))
+    try:
+        vector_db.upload_points(
+            collection_name=collection_name,
+            points=(chunk.to_qdrant_point_struct(**file_metadata_kwargs) for chunk in chunks),
+            batch_size=batch_size,
+            parallel=parallel,
+            wait=False,
+        )
+        wait_for_pending_updates(vector_db, collection_name)
+    finally:
+        # restore indexing, which builds the index over all uploaded points
+        vector_db.update_collection(collection_name=collection_name,
+                                    optimizer_config=OptimizersConfigDiff(indexing_threshold=indexing_threshold))
+    logger.info(f"Uploaded points to collection '{collection_name}'")
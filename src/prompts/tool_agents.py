@@ -44,9 +44,14 @@ TOOLS_OPENAI_SCHEMA = [
 ]
 
 
-MATH_REASONING_SYSTEM_TEMPLATE = """Il tuo compito è quello di scrivere il procedimento logico necessario ad ottenere un risultato numerico.
+# static system prompt (identical prefix across calls, so that it can be served from the provider prompt cache);
+# the context is sent in a separate message
+MATH_REASONING_SYSTEM_PROMPT = """Il tuo compito è quello di scrivere il procedimento logico necessario ad ottenere un risultato numerico.
 Non concentrarti sul'output finale, ma sul procedimento.
 
-Considera quanto segue per rispondere alla domanda:
+Considera il contesto fornito per rispondere alla domanda.
+"""
+
+MATH_REASONING_CONTEXT_TEMPLATE = """Contesto:
 {context}
 """
\ No newline at end of file
@@ -0,0 +1,226 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from array import array
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "data/cache"
+CACHE_MAX_ENTRIES = 32
+EMBEDDINGS_CACHE_FILE = os.path.join(CACHE_DIR, "embeddings.sqlite")
+QUERY_CACHE_TTL = 3600
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_SIMILARITY_THRESHOLD = 0.92
+
+
+def file_digest(file_path: str, block_size: int = 1 << 20) -> str:
+    """
+    Compute a content hash of a file, reading it in blocks to keep memory usage constant.
+
+    Args:
+        file_path: Path to the file to hash.
+        block_size: Number of bytes read at each iteration.
+
+    Returns:
+        str: The hex digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write_text(file_path: str, text: str):
+    """
+    Write a text file atomically: content is written to a temporary file in the same folder,
+    which is then renamed to the target path, so that readers never see a partially written file.
+    """
+    dir_name = os.path.dirname(file_path) or "."
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def evict_lru(pattern: str, max_entries: int = CACHE_MAX_ENTRIES):
+    """
+    Remove the least recently used files matching `pattern`, keeping at most `max_entries` of them.
+    Recency is tracked via file modification time, which is refreshed on every cache hit.
+    """
+    cached_files = sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)
+    for stale_file in cached_files[max_entries:]:
+        logger.debug(f'evicting cache file "{stale_file}"')
+        os.remove(stale_file)
+
+
+def load_cached_text(file_path: str) -> str | None:
+    """
+    Load the raw text of a cached file, returning None on cache miss, e.g. to validate it
+    directly with `model_validate_json`.
+    On cache hit, the file modification time is refreshed for LRU eviction.
+    """
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r", encoding="utf-8") as f:
+        cached = f.read()
+    os.utime(file_path)
+    return cached
+
+
+def load_cached_json(file_path: str) -> dict | list | None:
+    """
+    Load a cached JSON file, returning None on cache miss (see `load_cached_text`).
+    """
+    cached = load_cached_text(file_path)
+    return None if cached is None else json.loads(cached)
+
+
+def store_cached_json(file_path: str, payload: dict | list, max_entries: int = CACHE_MAX_ENTRIES):
+    """
+    Atomically store a JSON payload in the cache, evicting least recently used entries with the same prefix.
+    """
+    atomic_write_text(file_path, json.dumps(payload))
+    prefix = os.path.basename(file_path).split("_")[0]
+    evict_lru(os.path.join(os.path.dirname(file_path), f"{prefix}_*.json"), max_entries=max_entries)
+
+
+def text_digest(text: str) -> str:
+    """
+    Compute a content hash of a text, used as a stable cache key.
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by (embedding model, text content hash), backed by a SQLite file.
+    Vectors are stored as float32 blobs. Re-embedding the same documents (e.g. when re-indexing a collection
+    or trying a different chunking) then calls the embedding API only for new texts.
+    """
+
+    def __init__(self, file_path: str = EMBEDDINGS_CACHE_FILE):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT, digest TEXT, vector BLOB, PRIMARY KEY (model, digest))"
+        )
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        """
+        Return the cached embedding of each text, None on cache miss.
+        """
+        digests = [text_digest(text) for text in texts]
+        cached = {}
+        # bounded number of query parameters per statement
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT digest, vector FROM embeddings WHERE model = ? AND digest IN ({','.join('?' * len(batch))})",
+                [model, *batch],
+            )
+            cached.update(rows)
+        return [array("f", cached[digest]).tolist() if digest in cached else None for digest in digests]
+
+    def set_many(self, model: str, texts: list[str], vectors: list[list[float]]):
+        """
+        Store the embeddings of the texts.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, digest, vector) VALUES (?, ?, ?)",
+                [(model, text_digest(text), array("f", vector).tobytes()) for text, vector in zip(texts, vectors)],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class QueryCache:
+    """
+    In-memory cache of search results, with two levels:
+    - exact: results keyed by (query, limit);
+    - semantic: results of the most similar previous query, if its cosine similarity is at least
+      `similarity_threshold` (the LLM often rephrases the same search across turns).
+    Entries expire after `ttl` seconds; the oldest entries are overwritten once `max_entries` is reached.
+    """
+
+    def __init__(self,
+                 ttl: float = QUERY_CACHE_TTL,
+                 max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 similarity_threshold: float = QUERY_CACHE_SIMILARITY_THRESHOLD):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._exact: dict[tuple[str, int], tuple[float, list]] = {}
+        # ring buffer of normalized query embeddings, with the timestamp, limit and results of each entry
+        self._vectors: np.ndarray | None = None
+        self._timestamps = np.full(max_entries, -np.inf)
+        self._entries: list[tuple[int, list, tuple[str, int]] | None] = [None] * max_entries
+        self._next = 0
+
+    def get(self, query: str, limit: int) -> list | None:
+        """
+        Return the cached results of the same query with the same limit, None on cache miss.
+        """
+        cached = self._exact.get((query, limit))
+        if cached is None:
+            return None
+        timestamp, results = cached
+        if time.monotonic() - timestamp > self.ttl:
+            del self._exact[(query, limit)]
+            return None
+        return results
+
+    def get_similar(self, embedding: list[float], limit: int) -> list | None:
+        """
+        Return the cached results of the most similar previous query, cut to `limit`,
+        None if no query is similar enough or if it was searched with a lower limit.
+        """
+        if self._vectors is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None  # no direction to compare
+        similarities = self._vectors @ (vector / norm)
+        similarities[time.monotonic() - self._timestamps > self.ttl] = -np.inf
+        i = int(np.argmax(similarities))
+        if similarities[i] < self.similarity_threshold or self._entries[i][0] < limit:
+            return None
+        logger.debug(f'semantic cache hit with similarity {similarities[i]:.3f}')
+        return self._entries[i][1][:limit]
+
+    def set(self, query: str, limit: int, embedding: list[float], results: list):
+        """
+        Store the results of a query in both cache levels.
+        """
+        now = time.monotonic()
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        i = self._next
+        if self._entries[i] is not None:
+            # the overwritten entry leaves the exact level too, unless its query was stored again later
+            key = self._entries[i][2]
+            if key in self._exact and self._exact[key][0] == self._timestamps[i]:
+                del self._exact[key]
+        norm = np.linalg.norm(vector)
+        # zero vectors are stored as such: their similarity to any query is 0, i.e. never a semantic hit
+        self._vectors[i] = vector / norm if norm else 0.0
+        self._timestamps[i] = now
+        self._entries[i] = (limit, results, (query, limit))
+        self._next = (i + 1) % self.max_entries
+        self._exact[(query, limit)] = (now, results)
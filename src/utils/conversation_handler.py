@@ -1,5 +1,6 @@
-import asyncio
 import logging
+from dataclasses import dataclass, replace
+from typing import Any
 
 from mistralai import ToolCall
 from starlette.websockets import WebSocket
@@ -7,11 +8,39 @@ from starlette.websockets import WebSocket
 from llm_handlers.base_handler import BaseHandler
 from llm_handlers.mistral_handler import MistralHandler
 from prompts.routing_agent import ROUTING_AGENT_SYSTEM_PROMPT
-from utils.dto import InputMessage, OutputMessage, FIXED_FIELDS
+from utils.dto import InputMessage, OutputMessage, utc_timestamp
 from utils.tool_client import ToolClient
 
 logger = logging.getLogger(__name__)
 
+# user turns of the conversation sent to the LLM, and (among them) turns whose tool outputs are sent in full
+CONTEXT_USER_TURNS = 10
+FULL_TOOL_OUTPUT_TURNS = 2
+STALE_TOOL_OUTPUT = "Tool output omitted (older than the last turns of the conversation)."
+
+
+@dataclass(slots=True, frozen=True)
+class Message:
+    """
+    A message of the conversation. Messages are stored as compact slotted objects and converted to
+    the chat API format (see `to_dict`) only when sent to the LLM.
+    """
+    role: str
+    content: str | None
+    tool_calls: tuple[Any, ...] = ()
+    tool_call_id: str | None = None
+    name: str | None = None
+
+    def to_dict(self) -> dict:
+        message = {"role": self.role, "content": self.content}
+        if self.tool_calls:
+            message["tool_calls"] = list(self.tool_calls)
+        if self.tool_call_id is not None:
+            message["tool_call_id"] = self.tool_call_id
+        if self.name is not None:
+            message["name"] = self.name
+        return message
+
 
 class ConversationHandler:
     """
@@ -31,90 +60,118 @@ class ConversationHandler:
         self.websocket = websocket
 
         # Initialize the conversation
-        self.current_conversation: list[dict] = self.conversation_db.get(self.input_dto.conversation_id, [])
+        self.current_conversation: list[Message] = self.conversation_db.get(self.input_dto.conversation_id, [])
 
-    async def post_event(self, data):
+    async def post_event(self, data: str) -> None:
         if self.websocket:
             await self.websocket.send_text(data)
         else:
             logger.debug(f"WebSocket not available. Data: {data}")
 
-    def update_conversation(self, conversation_id, update_dict: dict | None = None):
-        """ Incremental update of the conversation in the database. """
-        to_update = {'last_update_timestamp': self.input_dto.timestmap}
+    def update_conversation(self, conversation_id: str, update_dict: dict | None = None,
+                            timestamp: str | None = None) -> None:
+        """
+        Incremental update of the conversation in the database, at `timestamp` (the input message one by default).
+        """
+        to_update = {'last_update_timestamp': timestamp or self.input_dto.timestamp}
         if update_dict:
             to_update = {**to_update, **update_dict}
         # TODO: Uncomment the following line when conversation_db is implemented
         # self.conversation_db.update(conversation_id, to_update)
 
-    async def routing_agent(self):
+    def _prepare_messages(self) -> list[dict]:
         """
-        This method contains the LLM call to the routing agent.
-        If the agent return tool calls responses, it handles them and invokes the routing agent again.
-        Otherwise, the function ends (assistant responses are stored in current_conversation attribute).
+        Build the messages sent to the LLM, bounding their size as the conversation grows: the system prompt,
+        then the last `CONTEXT_USER_TURNS` user turns, where tool outputs older than the last
+        `FULL_TOOL_OUTPUT_TURNS` turns are replaced by a placeholder.
+        Turns are cut at user messages, so that tool messages always follow the assistant message with their tool calls.
         """
-        response = self.llm_handler.invoke_with_retry(
-            method="complete",
-            messages=self.current_conversation,
-            temperature=0.7,
-            tools=self.tool_client.tools,
-        )
-        response_msg = response.choices[0].message
-        self.current_conversation.append({
-            "role": "assistant",
-            "content": response_msg.content,
-        })
-        if response_msg.tool_calls is not None:
-            self.current_conversation[-1]["tool_calls"] = response_msg.tool_calls
-            for tool_call in response_msg.tool_calls:
-                await self.handle_tool_call(tool_call)
-                await self.routing_agent()
-
-    async def handle_tool_call(self, tool_call: ToolCall):
+        system, history = self.current_conversation[:1], self.current_conversation[1:]
+        user_turns = [i for i, message in enumerate(history) if message.role == "user"]
+        start = user_turns[-CONTEXT_USER_TURNS] if len(user_turns) > CONTEXT_USER_TURNS else 0
+        full_tool_output_start = user_turns[-FULL_TOOL_OUTPUT_TURNS] if len(user_turns) > FULL_TOOL_OUTPUT_TURNS else 0
+        # messages are converted to the chat API format only here, once per LLM call
+        messages = [message.to_dict() for message in system]
+        for i, message in enumerate(history[start:], start):
+            if message.role == "tool" and i < full_tool_output_start:
+                message = replace(message, content=STALE_TOOL_OUTPUT)
+            messages.append(message.to_dict())
+        return messages
+
+    async def routing_agent(self) -> None:
+        """
+        This method contains the LLM calls to the routing agent.
+        While the agent returns tool calls, it handles them (all tool calls of a turn run concurrently)
+        and invokes the routing agent again.
+        Otherwise, the loop ends (assistant responses are stored in current_conversation attribute).
         """
-        Handles the tool call by executing the corresponding function and updating the conversation.
+        while True:
+            # async LLM call, so that the event loop keeps serving other conversations
+            response = await self.llm_handler.ainvoke_with_retry(
+                method="complete",
+                messages=self._prepare_messages(),
+                temperature=0.7,
+                tools=self.tool_client.tools,
+            )
+            response_msg = response.choices[0].message
+            self.current_conversation.append(Message(
+                role="assistant",
+                content=response_msg.content,
+                tool_calls=tuple(response_msg.tool_calls or ()),
+            ))
+            if not response_msg.tool_calls:
+                break
+            self.current_conversation.extend(await self.handle_tool_calls(response_msg.tool_calls))
+
+    async def handle_tool_calls(self, tool_calls: list[ToolCall]) -> list[Message]:
+        """
+        Handles the tool calls of an agent turn by executing the corresponding functions concurrently.
 
         Parameters:
-            tool_call (ToolCall): The tool call object containing the function name and arguments.
+            tool_calls (list[ToolCall]): The tool call objects containing the function names and arguments.
+
+        Returns:
+            list[Message]: The tool messages with the results, to be added to the conversation
+                in the same order as the tool calls.
         """
-        tool_call_id = tool_call.id
-        tool_name = tool_call.function.name
-        tool_args = tool_call.function.arguments
-        await self.post_event(f'    🛠️ "{tool_name}" {tool_args}')
-        await asyncio.sleep(0.5)  # Simulate some delay for the tool call
-        result = self.tool_client.execute(tool_name, tool_args)
-
-        await self.post_event(f'    🛠️ Tool ended with result: {result}')
-
-        self.current_conversation.append({
-            "role": "tool",
-            "name": tool_name,
-            "content": result,
-            "tool_call_id": tool_call_id
-        })
-
-    async def main(self):
+        for tool_call in tool_calls:
+            await self.post_event(f'    🛠️ "{tool_call.function.name}" {tool_call.function.arguments}')
+        results = await self.tool_client.execute_many(
+            [(tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls]
+        )
+        tool_messages = []
+        for tool_call, result in zip(tool_calls, results):
+            await self.post_event(f'    🛠️ Tool ended with result: {result}')
+            tool_messages.append(Message(
+                role="tool",
+                name=tool_call.function.name,
+                content=result,
+                tool_call_id=tool_call.id,
+            ))
+        return tool_messages
+
+    async def main(self) -> OutputMessage:
         """
         Main function to handle the conversation. Adds system and user messages to the conversation,
         then invokes the routing agent to process the conversation.
         Finally, it updates the conversation database and returns the output message.
         """
         if len(self.current_conversation) == 0:
-            self.current_conversation.append({
-                "role": "system",
-                "content": ROUTING_AGENT_SYSTEM_PROMPT
-            })
+            self.current_conversation.append(Message(role="system", content=ROUTING_AGENT_SYSTEM_PROMPT))
 
         await self.post_event(f'👤: {self.input_dto.message}')
-        self.current_conversation.append({
-            "role": "user",
-            "content": self.input_dto.message,
-        })
+        self.current_conversation.append(Message(role="user", content=self.input_dto.message))
         await self.routing_agent()
-        await self.post_event(f'🤖: {self.current_conversation[-1]["content"]}')
+        await self.post_event(f'🤖: {self.current_conversation[-1].content}')
         self.conversation_db[self.input_dto.conversation_id] = self.current_conversation
+        # the response time is read once, for the output message and for the conversation update
+        response_timestamp = utc_timestamp()
         output_message = OutputMessage(
-            **self.input_dto.model_dump(include=FIXED_FIELDS),
-            message=self.current_conversation[-1]["content"],
+            conversation_id=self.input_dto.conversation_id,
+            correlation_id=self.input_dto.correlation_id,
+            # the LLM may return no content at all
+            message=self.current_conversation[-1].content or "",
+            timestamp=response_timestamp,
         )
+        self.update_conversation(self.input_dto.conversation_id, timestamp=response_timestamp)
         return output_message
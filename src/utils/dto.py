@@ -1,20 +1,39 @@
 import datetime
-import uuid
+import secrets
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
+_now = datetime.datetime.now
+
+
+def _new_id() -> str:
+    return secrets.token_hex(16)
+
+
+def utc_timestamp() -> str:
+    """
+    Current time as an ISO 8601 string in UTC, with explicit offset (e.g. "2025-04-20T10:00:00.123456+00:00").
+    Timestamps of messages and conversation updates were naive local times (no offset) before,
+    readers of stored conversations must accept both formats.
+    """
+    return _now(tz=datetime.timezone.utc).isoformat()
 
-FIXED_FIELDS = {'conversation_id', 'correlation_id'}
 
 class InputMessage(BaseModel):
-    correlation_id: str = Field(default_factory=lambda: uuid.uuid4().hex, description="ID for correlation input and output")
+    # messages are immutable once received, unknown fields are rejected
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    correlation_id: str = Field(default_factory=_new_id, description="ID for correlation input and output")
     conversation_id: str = Field(..., description="The ID of the conversation")
     user_id: str = Field(..., description="The ID of the user")
     message: str = Field(..., description="The message content")
-    timestamp: str = Field(default_factory=lambda: datetime.datetime.now().isoformat(), description="The timestamp of the message")
+    timestamp: str = Field(default_factory=utc_timestamp, description="The timestamp of the message")
 
 class OutputMessage(BaseModel):
-    correlation_id: str = Field(default_factory=lambda: uuid.uuid4().hex, description="ID for correlation input and output")
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    # always the correlation_id of the input message, for tracing
+    correlation_id: str = Field(..., description="ID for correlation input and output")
     conversation_id: str = Field(..., description="The ID of the conversation")
     message: str = Field(..., description="The message content")
-    timestamp: str = Field(default_factory=lambda: datetime.datetime.now().isoformat(), description="The timestamp of the message")
+    timestamp: str = Field(default_factory=utc_timestamp, description="The timestamp of the message")
@@ -5,6 +5,7 @@ LOG_CONFIG = {
     'level': os.getenv("LOG_LEVEL", logging.DEBUG),
     'format': '%(asctime)s; %(levelname)s; %(name)s; %(funcName)s:%(lineno)d; %(message)s',
 }
+VALID_LEVELS = frozenset({'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'})
 
 def filter_loggers(lib_level_dict: dict[str, str]):
     """
@@ -14,6 +15,6 @@ def filter_loggers(lib_level_dict: dict[str, str]):
         lib_level_dict: Dictionary mapping library names to logging levels.
     """
     for lib_name, level in lib_level_dict.items():
-        if level not in {'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'}:
+        if level not in VALID_LEVELS:
             raise ValueError(f"Invalid logging level: {level} for library: {lib_name}")
         logging.getLogger(lib_name).setLevel(level)
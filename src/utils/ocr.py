@@ -1,9 +1,21 @@
-from mistralai import OCRResponse
+import base64
+import mimetypes
+import os
+import re
+import time
+
+from mistralai import Mistral, OCRResponse
+
+from utils.cache import CACHE_DIR, load_cached_json, store_cached_json
+
+# image placeholder as emitted by the OCR, e.g. `![img-0.jpeg](img-0.jpeg)`
+_IMG_RE = re.compile(r'!\[([^\]]+)\]\(\1\)')
 
 
 def replace_images_in_markdown(markdown_str: str, images_dict: dict) -> str:
     """
     Replace image placeholders in markdown with base64-encoded images.
+    All placeholders are replaced in a single pass over the markdown text.
 
     Args:
         markdown_str: Markdown text containing image placeholders
@@ -12,19 +24,60 @@ def replace_images_in_markdown(markdown_str: str, images_dict: dict) -> str:
     Returns:
         Markdown text with images replaced by base64 data
     """
-    for img_name, base64_str in images_dict.items():
-        markdown_str = markdown_str.replace(
-            f"![{img_name}]({img_name})", f"![{img_name}]({base64_str})"
-        )
-    return markdown_str
+    if not images_dict:
+        return markdown_str
+
+    def replace(match: re.Match) -> str:
+        img_name = match.group(1)
+        if img_name not in images_dict:
+            return match.group(0)
+        return f"![{img_name}]({images_dict[img_name]})"
+
+    return _IMG_RE.sub(replace, markdown_str)
+
+
+def export_images(ocr_response: OCRResponse, images_dir: str) -> OCRResponse:
+    """
+    Move base64-encoded images out of the OCR response into binary side-car files,
+    i.e. `{images_dir}/{image_id}`, so that the OCR JSON stored on disk stays small.
+    Images are re-materialized lazily by `get_combined_markdown`.
 
+    Args:
+        ocr_response: Response from OCR processing containing text and images
+        images_dir: Folder where images are written
 
-def get_combined_markdown(ocr_response: OCRResponse) -> str:
+    Returns:
+        The same OCR response, with `image_base64` set to None for every exported image
+    """
+    for page in ocr_response.pages:
+        for img in page.images:
+            if not img.image_base64:
+                continue
+            # images are returned as data URI, e.g. "data:image/jpeg;base64,..."
+            _, _, base64_str = img.image_base64.rpartition(",")
+            os.makedirs(images_dir, exist_ok=True)
+            with open(os.path.join(images_dir, img.id), "wb") as f:
+                f.write(base64.b64decode(base64_str))
+            img.image_base64 = None
+    return ocr_response
+
+
+def load_image_base64(image_path: str) -> str:
+    """
+    Load an image exported by `export_images` as a base64 data URI.
+    """
+    mime_type = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+    with open(image_path, "rb") as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+def get_combined_markdown(ocr_response: OCRResponse, images_dir: str | None = None) -> str:
     """
     Combine OCR text and images into a single markdown document.
 
     Args:
         ocr_response: Response from OCR processing containing text and images
+        images_dir: Folder with images exported by `export_images`, used for images without base64 data
 
     Returns:
         Combined markdown string with embedded images
@@ -34,9 +87,35 @@ def get_combined_markdown(ocr_response: OCRResponse) -> str:
     for page in ocr_response.pages:
         image_data = {}
         for img in page.images:
-            image_data[img.id] = img.image_base64
+            image_base64 = img.image_base64
+            if image_base64 is None and images_dir and os.path.exists(os.path.join(images_dir, img.id)):
+                image_base64 = load_image_base64(os.path.join(images_dir, img.id))
+            image_data[img.id] = image_base64
         # Replace image placeholders with actual images
         markdowns.append(replace_images_in_markdown(page.markdown, image_data))
 
     return "\n\n".join(markdowns)
 
+
+def get_signed_url(client: Mistral, file_id: str, expiry_hours: int = 24, min_validity_seconds: int = 300) -> str:
+    """
+    Return a signed URL for an uploaded Mistral file, reusing the one cached on disk
+    while it is still valid for at least `min_validity_seconds`.
+
+    Args:
+        client: Mistral client used to request a new signed URL on cache miss.
+        file_id: ID of the uploaded file.
+        expiry_hours: Validity of newly requested signed URLs.
+        min_validity_seconds: Minimum residual validity for a cached signed URL to be reused.
+
+    Returns:
+        str: The signed URL of the file.
+    """
+    cache_file = os.path.join(CACHE_DIR, f"signed_url_{file_id}.json")
+    cached = load_cached_json(cache_file)
+    if cached is not None and cached["expires_at"] - time.time() > min_validity_seconds:
+        return cached["url"]
+    expires_at = time.time() + expiry_hours * 3600
+    signed_url = client.files.get_signed_url(file_id=file_id, expiry=expiry_hours)
+    store_cached_json(cache_file, {"url": signed_url.url, "expires_at": expires_at})
+    return signed_url.url
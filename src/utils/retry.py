@@ -0,0 +1,126 @@
+import asyncio
+import email.utils
+import functools
+import logging
+import random
+import time
+from typing import Callable
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+TRANSIENT_MESSAGES = ("rate limit", "quota", "too many requests", "timed out", "timeout")
+
+
+def get_status_code(e: Exception) -> int | None:
+    """
+    Return the HTTP status code carried by an exception, if any.
+    SDK errors (Mistral, OpenAI) expose `status_code` directly, while requests/httpx errors
+    expose it on the attached `response`.
+    """
+    status_code = getattr(e, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status_code
+
+
+def is_transient_error(e: Exception) -> bool:
+    """
+    Classify an exception as transient (rate limit, quota, server-side or network error),
+    i.e. an error worth retrying.
+
+    Args:
+        e: The exception raised by the API call.
+
+    Returns:
+        bool: True if the call should be retried, False if it should fail fast.
+    """
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    if get_status_code(e) in TRANSIENT_STATUS_CODES:
+        return True
+    message = str(e).lower()
+    return any(m in message for m in TRANSIENT_MESSAGES)
+
+
+def get_retry_after(e: Exception) -> float | None:
+    """
+    Return the waiting time (in seconds) requested by the server through the `Retry-After` header
+    of the failing response, if any. The header can hold either a number of seconds or an HTTP date.
+    SDK errors expose the response as `response` (OpenAI, httpx) or `raw_response` (Mistral).
+    """
+    response = getattr(e, 'response', None) or getattr(e, 'raw_response', None)
+    headers = getattr(response, 'headers', None) or getattr(e, 'headers', None)
+    retry_after = headers.get('retry-after') if headers else None
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def backoff_time(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """
+    Exponential backoff with jitter: `base * 2 ** attempt` plus up to one second of jitter, capped at `cap`.
+    """
+    return min(cap, base * 2 ** attempt + random.uniform(0, 1))
+
+
+def retry_wait_time(e: Exception, attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """
+    Waiting time before retrying after error `e`: the `Retry-After` value of the failing response plus
+    a small jitter (so that concurrent clients do not retry all at once), exponential backoff otherwise.
+    """
+    retry_after = get_retry_after(e)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 0.5)
+    return backoff_time(attempt, base, cap)
+
+
+def retry_on_transient(max_attempts: int = 5, base: float = 1.0, cap: float = 30.0) -> Callable:
+    """
+    Decorator retrying a sync or async function on transient errors with exponential backoff.
+    Non-transient errors are raised immediately, transient ones are raised once attempts are exhausted.
+
+    Args:
+        max_attempts: Max number of invocations of the decorated function.
+        base: Base waiting time (in seconds) of the exponential backoff.
+        cap: Max waiting time (in seconds) between two attempts.
+    """
+    def decorator(fn: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                for attempt in range(max_attempts):
+                    try:
+                        return await fn(*args, **kwargs)
+                    except Exception as e:
+                        if not is_transient_error(e) or attempt == max_attempts - 1:
+                            raise
+                        wait_time = retry_wait_time(e, attempt, base, cap)
+                        logger.warning(f'{fn.__name__} failed ({e}). Retrying in {wait_time:.2f} seconds.')
+                        await asyncio.sleep(wait_time)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if not is_transient_error(e) or attempt == max_attempts - 1:
+                        raise
+                    wait_time = retry_wait_time(e, attempt, base, cap)
+                    logger.warning(f'{fn.__name__} failed ({e}). Retrying in {wait_time:.2f} seconds.')
+                    time.sleep(wait_time)
+        return wrapper
+
+    return decorator
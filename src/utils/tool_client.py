@@ -1,47 +1,68 @@
-import json
+import asyncio
+import functools
+import inspect
 import logging
 import os
+from types import MappingProxyType
 
-from qdrant_client import QdrantClient
+import httpx
+from pydantic_core import from_json, to_json
+from qdrant_client import AsyncQdrantClient, models
 
 from llm_handlers.base_handler import BaseHandler
 from llm_handlers.jina_handler import JinaHandler
-from prompts.tool_agents import TOOLS_OPENAI_SCHEMA, MATH_REASONING_SYSTEM_TEMPLATE
+from prompts.tool_agents import TOOLS_OPENAI_SCHEMA, MATH_REASONING_SYSTEM_PROMPT, MATH_REASONING_CONTEXT_TEMPLATE
+from utils.cache import QueryCache
 
 logger = logging.getLogger(__name__)
 
+# connection pool of the async Qdrant client, shared by concurrent tool calls
+QDRANT_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+# max number of tool calls running at the same time, per tool client
+TOOL_CONCURRENCY_LIMIT = int(os.getenv("TOOL_CONCURRENCY_LIMIT", 8))
+
+
+@functools.lru_cache(maxsize=None)
+def get_vector_db() -> AsyncQdrantClient:
+    """
+    Return the Qdrant client shared by all the tool clients of the process, built from the environment:
+    a remote client if `QDRANT_URL` is set (using gRPC if `QDRANT_GRPC_PORT` is set too), an embedded one
+    at `QDRANT_PATH_TO_DB` otherwise. The embedded database is locked by a single client per process.
+    """
+    qdrant_url = os.getenv('QDRANT_URL')
+    qdrant_port = os.getenv('QDRANT_PORT')
+    qdrant_grpc_port = os.getenv('QDRANT_GRPC_PORT')
+    if qdrant_url:
+        if qdrant_grpc_port:
+            # binary protobuf over a single multiplexed channel, shared by concurrent searches
+            return AsyncQdrantClient(url=qdrant_url, port=qdrant_port and int(qdrant_port),
+                                     grpc_port=int(qdrant_grpc_port), prefer_grpc=True, timeout=60)
+        return AsyncQdrantClient(url=f"{qdrant_url}:{qdrant_port}", timeout=60, limits=QDRANT_HTTP_LIMITS)
+    logger.debug(f'loading local Qdrant client at "{os.getenv("QDRANT_PATH_TO_DB")}"')
+    os.makedirs(os.getenv("QDRANT_PATH_TO_DB"), exist_ok=True)
+    return AsyncQdrantClient(path=os.getenv("QDRANT_PATH_TO_DB"), force_disable_check_same_thread=True)
+
 
 class ToolClient:
     def __init__(self, llm_handler: BaseHandler,
                  embeddings_handler: JinaHandler,
                  collection_name: str,
-                 vector_db: QdrantClient | None = None
+                 vector_db: AsyncQdrantClient | None = None,
+                 query_cache: QueryCache | None = None
                  ):
         self.llm_handler = llm_handler
         self.embeddings_handler = embeddings_handler
-        if vector_db:
-            self.vector_db = vector_db
-        else:
-            qdrant_url = os.getenv('QDRANT_URL')
-            qdrant_port = os.getenv('QDRANT_PORT')
-            if qdrant_url:
-                self.vector_db = QdrantClient(url=f"{qdrant_url}:{qdrant_port}")
-            else:
-                logger.debug(f'loading local Qdrant client at "{os.getenv("QDRANT_PATH_TO_DB")}"')
-                os.makedirs(os.getenv("QDRANT_PATH_TO_DB"), exist_ok=True)
-                self.vector_db = QdrantClient(path=os.getenv("QDRANT_PATH_TO_DB"),
-                                              force_disable_check_same_thread=True)
+        self.vector_db = vector_db or get_vector_db()
         self.collection_name = collection_name
+        # cache of get_context results, for repeated or rephrased searches
+        self.query_cache = query_cache if query_cache is not None else QueryCache()
 
-        # Initialize tools
-        self.tool_to_function = {
-            "math_reasoning": self.math_reasoning,
-            "get_context": self.get_context
-        }
+        # Initialize tools (the dispatch table is built once, see `TOOL_DISPATCH`)
         self.tools = TOOLS_OPENAI_SCHEMA
+        self._tool_semaphore = asyncio.Semaphore(TOOL_CONCURRENCY_LIMIT)
 
 
-    def math_reasoning(self, question: str, context: str) -> str:
+    async def math_reasoning(self, question: str, context: str) -> str:
         """
         This function is used to perform mathematical reasoning based on the provided question and context.
         It is designed to generate a logical procedure to arrive at a numerical result.
@@ -53,43 +74,114 @@ class ToolClient:
         messages = [
             {
                 "role": "system",
-                "content": MATH_REASONING_SYSTEM_TEMPLATE.format(context=context)
+                "content": MATH_REASONING_SYSTEM_PROMPT
             },
+            {"role": "user", "content": MATH_REASONING_CONTEXT_TEMPLATE.format(context=context)},
             {"role": "user", "content": question},
         ]
-        response = self.llm_handler.invoke_with_retry(
+        response = await self.llm_handler.ainvoke_with_retry(
             method="complete",
             messages=messages,
         )
         return response.choices[0].message.content
 
-    def get_context(self, search_query: str, limit: int = 3, max_limit: int = 20, min_limit: int = 3) -> list[dict]:
+    @staticmethod
+    def _context_limit(limit: int = 3, max_limit: int = 20, min_limit: int = 3) -> int:
+        logger.debug(f'limit {limit} forced to be between {min_limit} and {max_limit}')
+        limit = min(limit, max_limit)
+        return max(limit, min_limit)
+
+    @staticmethod
+    def _format_points(points: list[models.ScoredPoint]) -> list[dict]:
+        # only the fields useful to the LLM are kept (no vectors, versions, ...), to shrink the prompt;
+        # points are already sorted by decreasing score by Qdrant
+        return [{"id": p.id, "score": p.score, "text": p.payload.get("text", "")} for p in points]
+
+    async def get_context(self, search_query: str, limit: int = 3, max_limit: int = 20, min_limit: int = 3) -> list[dict]:
         """
         This function is used to search for information in the vector store.
         It implements a query search that expands the user input with a hypothetical answer to increase cosine similarity with stored chunks.
+        Embedding and search are awaited, so that the event loop keeps serving other conversations meanwhile.
+        Results are cached (see `QueryCache`): a repeated query skips both the embedding and the search,
+        a query similar enough to a previous one skips the search.
 
         Parameters:
             search_query (str): The query to search for in the vector store.
             limit (int): The maximum number of results to return. Default is 3.
         """
-        embedded_query_resp = self.embeddings_handler.invoke_with_retry(
-            'embed', messages=[{'text': search_query}],
-            to_embed_key="text",
-        )
-        embedded_query = embedded_query_resp.data[0].embedding
-        logger.debug(f'limit {limit} forced to be between {min_limit} and {max_limit}')
-        limit = min(limit, max_limit)
-        limit = max(limit, min_limit)
-        results = self.vector_db.query_points(
+        limit = self._context_limit(limit, max_limit, min_limit)
+        cached = self.query_cache.get(search_query, limit)
+        if cached is not None:
+            return cached
+        # single queries of concurrent conversations are coalesced in the same embedding request
+        embedded_query = await self.embeddings_handler.embed_batched(search_query)
+        cached = self.query_cache.get_similar(embedded_query, limit)
+        if cached is not None:
+            return cached
+        results = await self.vector_db.query_points(
             collection_name=self.collection_name,
             query=embedded_query,
             limit=limit,
             with_payload=True,
+            with_vectors=False,
+        )
+        context = self._format_points(results.points)
+        self.query_cache.set(search_query, limit, embedded_query, context)
+        return context
+
+    @classmethod
+    def _context_args(cls, tool_args: dict) -> tuple[str, int]:
+        """
+        Validate the arguments of a `get_context` call as `get_context` itself would (unexpected or missing
+        arguments raise a TypeError), returning its search query and limit.
+        """
+        bound = cls._GET_CONTEXT_SIGNATURE.bind(None, **tool_args)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        if not isinstance(arguments["search_query"], str):
+            raise TypeError("search_query must be a string")
+        return arguments["search_query"], cls._context_limit(arguments["limit"], arguments["max_limit"],
+                                                             arguments["min_limit"])
+
+    async def get_contexts(self, tool_args_list: list[dict]) -> list[list[dict]]:
+        """
+        Batched version of `get_context`, for several searches requested in the same agent turn:
+        all the queries are embedded together (see `JinaHandler.embed_batched`) and searched with a single Qdrant batch query.
+        Only queries missing from the cache are embedded and searched.
+
+        Parameters:
+            tool_args_list (list[dict]): The arguments of each `get_context` call.
+
+        Returns:
+            list[list[dict]]: The results of each search, in the same order as the arguments.
+        """
+        search_queries, limits = map(list, zip(*(self._context_args(tool_args) for tool_args in tool_args_list)))
+        contexts = [self.query_cache.get(query, limit) for query, limit in zip(search_queries, limits)]
+        to_embed = [i for i, context in enumerate(contexts) if context is None]
+        if not to_embed:
+            return contexts
+        embedded_queries = dict(zip(to_embed, await asyncio.gather(
+            *(self.embeddings_handler.embed_batched(search_queries[i]) for i in to_embed)
+        )))
+        to_search = []
+        for i, embedded_query in embedded_queries.items():
+            contexts[i] = self.query_cache.get_similar(embedded_query, limits[i])
+            if contexts[i] is None:
+                to_search.append(i)
+        if not to_search:
+            return contexts
+        results = await self.vector_db.query_batch_points(
+            collection_name=self.collection_name,
+            requests=[models.QueryRequest(query=embedded_queries[i], limit=limits[i],
+                                          with_payload=True, with_vector=False)
+                      for i in to_search],
         )
-        result_text = sorted(results.points, key=lambda x: x.score, reverse=True)
-        return [r.model_dump() for r in result_text]
+        for i, result in zip(to_search, results):
+            contexts[i] = self._format_points(result.points)
+            self.query_cache.set(search_queries[i], limits[i], embedded_queries[i], contexts[i])
+        return contexts
 
-    def execute(self, tool_name: str, tool_arguments: str) -> str:
+    async def execute(self, tool_name: str, tool_arguments: str) -> str:
         """
         Execute a tool based on the tool name and arguments provided.
 
@@ -97,16 +189,88 @@ class ToolClient:
             tool_name (str): The name of the tool to execute.
             tool_arguments (str): The arguments for the tool in JSON format.
         """
-        if tool_name in self.tool_to_function:
-            function = self.tool_to_function[tool_name]
+        function = self.TOOL_DISPATCH.get(tool_name)
+        if function is not None:
+            function = function.__get__(self)
             try:
-                tool_args = json.loads(tool_arguments)
+                tool_args = from_json(tool_arguments)
                 logger.debug(f"Calling tool {tool_name} with arguments: {tool_args}")
-                result = function(**tool_args)
+                async with self._tool_semaphore:
+                    result = await function(**tool_args)
                 logger.debug(f"Tool {tool_name} result: {result}")
-                result = json.dumps(result, indent=4)
+                # compact JSON (no indentation, no escaped non-ASCII characters): fewer prompt tokens for the LLM
+                result = to_json(result).decode()
             except Exception as e:
                 result = f"Error executing tool {tool_name}: {str(e)}"
         else:
-            result = f"Tool {tool_name} not found in tool_to_function mapping."
-        return  result
\ No newline at end of file
+            result = f"Tool {tool_name} not found in TOOL_DISPATCH mapping."
+        return  result
+
+    async def execute_many(self, tool_calls: list[tuple[str, str]]) -> list[str]:
+        """
+        Execute the tool calls of an agent turn concurrently (see `execute`), at most `TOOL_CONCURRENCY_LIMIT`
+        at a time. Multiple `get_context` calls are batched (see `get_contexts`).
+        Errors are isolated: a failing tool call returns an error message, without affecting the others.
+
+        Parameters:
+            tool_calls (list[tuple[str, str]]): The name and the JSON arguments of each tool call.
+
+        Returns:
+            list[str]: The result of each tool call, in the same order as the tool calls.
+        """
+        context_calls = [i for i, (tool_name, _) in enumerate(tool_calls) if tool_name == "get_context"]
+        if len(context_calls) < 2:
+            return list(await asyncio.gather(*(self.execute(*tool_call) for tool_call in tool_calls)))
+        other_calls = [i for i, (tool_name, _) in enumerate(tool_calls) if tool_name != "get_context"]
+        context_results, *other_results = await asyncio.gather(
+            self._execute_get_contexts([tool_calls[i][1] for i in context_calls]),
+            *(self.execute(*tool_calls[i]) for i in other_calls),
+        )
+        results = [""] * len(tool_calls)
+        for i, result in zip(context_calls + other_calls, context_results + other_results):
+            results[i] = result
+        return results
+
+    async def _execute_get_contexts(self, tool_arguments_list: list[str]) -> list[str]:
+        # arguments are validated call by call, so that a malformed call fails alone and the others are batched
+        results = [""] * len(tool_arguments_list)
+        valid_calls, tool_args_list = [], []
+        for i, tool_arguments in enumerate(tool_arguments_list):
+            try:
+                tool_args = from_json(tool_arguments)
+                self._context_args(tool_args)
+            except Exception as e:
+                results[i] = f"Error executing tool get_context: {str(e)}"
+                continue
+            valid_calls.append(i)
+            tool_args_list.append(tool_args)
+        if not valid_calls:
+            return results
+        try:
+            logger.debug(f"Calling tool get_context in batch with arguments: {tool_args_list}")
+            async with self._tool_semaphore:
+                contexts = await self.get_contexts(tool_args_list)
+            for i, context in zip(valid_calls, contexts):
+                results[i] = to_json(context).decode()
+        except Exception as e:
+            for i in valid_calls:
+                results[i] = f"Error executing tool get_context: {str(e)}"
+        return results
+
+    async def aclose(self) -> None:
+        """
+        Close the connections of the vector store and of the embeddings handler.
+        """
+        await self.vector_db.close()
+        if get_vector_db.cache_info().currsize and self.vector_db is get_vector_db():
+            get_vector_db.cache_clear()  # the next tool client gets a new connection
+        await self.embeddings_handler.aclose()
+
+    # tools dispatch, built once per class instead of once per instance: functions are bound on call.
+    # Tools are coroutines, awaited directly on the event loop
+    TOOL_DISPATCH = MappingProxyType({
+        "math_reasoning": math_reasoning,
+        "get_context": get_context,
+    })
+    # signature used to validate the arguments of batched get_context calls
+    _GET_CONTEXT_SIGNATURE = inspect.signature(get_context)
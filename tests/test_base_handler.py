@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+
+import pytest
+
+from llm_handlers import base_handler
+from llm_handlers.base_handler import BaseHandler
+from llm_handlers.jina_handler import JinaEmbeddingResponse, JinaEmbeddingUsage, JinaVector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeHandler(BaseHandler):
+    def update_state(self, response):
+        pass
+
+    def _complete(self, messages, *args, **kwargs):
+        pass
+
+    def _parse(self, messages, *args, **kwargs):
+        pass
+
+    def _embed(self, texts, *args, **kwargs):
+        pass
+
+
+class TransientError(Exception):
+    status_code = 503
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(base_handler, "time", SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    return clock
+
+
+def test_dedupe_texts_and_scatter():
+    texts = ["a", "b", "a", "c", "b"]
+    unique_texts, text_positions = BaseHandler.dedupe_texts(texts)
+    assert unique_texts == ["a", "b", "c"]
+    assert text_positions == [0, 1, 0, 2, 1]
+
+    response = JinaEmbeddingResponse(
+        usage=JinaEmbeddingUsage(),
+        data=[JinaVector([float(i)], index=i) for i in range(len(unique_texts))],
+    )
+    scattered = response.scatter(text_positions)
+    assert [v.embedding for v in scattered.data] == [[0.0], [1.0], [0.0], [2.0], [1.0]]
+    assert [v.index for v in scattered.data] == list(range(len(texts)))
+
+
+def test_rps_bucket_spaces_requests(clock):
+    handler = FakeHandler(rps_limit=2)
+    # the bucket starts full: a burst of `rps_limit` requests is sent at once
+    assert handler._reserve() == 0
+    assert handler._reserve() == 0
+    # next requests get consecutive slots
+    assert handler._reserve() == pytest.approx(0.5)
+    assert handler._reserve() == pytest.approx(1.0)
+    clock.now += 1.0
+    assert handler._reserve() == pytest.approx(0.5)
+
+
+def test_tpm_bucket_debt_and_refund(clock):
+    handler = FakeHandler(tpm_limit=600)  # 10 tokens per second
+    assert handler._reserve(tokens=600) == 0
+    # used tokens are known after the response: the debt is waited for by the next request
+    handler.consume_tokens(100)
+    assert handler._reserve() == pytest.approx(10.0)
+    # the bucket refills over time (a minute refills the limit), paying back the debt first
+    clock.now += 60
+    assert handler._reserve(tokens=100) == 0
+    assert handler._tpm_bucket['tokens'] == pytest.approx(400)
+    # refunded tokens are available again
+    handler.consume_tokens(-100)
+    assert handler._tpm_bucket['tokens'] == pytest.approx(500)
+
+
+def test_call_with_retry_retries_transient_errors_and_refunds_tokens(clock, monkeypatch):
+    monkeypatch.setattr(base_handler, "retry_wait_time", lambda e, attempt: 0.0)
+    handler = FakeHandler(tpm_limit=600, max_retries=3)
+    calls = []
+
+    def request(x):
+        calls.append(x)
+        if len(calls) < 3:
+            raise TransientError("service unavailable")
+        return x
+
+    assert handler.call_with_retry("test", request, prompt_tokens=50, x=1) == 1
+    assert len(calls) == 3
+    # tokens reserved before each attempt are refunded after it
+    assert handler._tpm_bucket['tokens'] == pytest.approx(600)
+
+
+def test_call_with_retry_fails_fast_on_non_transient_errors(clock):
+    handler = FakeHandler(max_retries=3)
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        handler.call_with_retry("test", request)
+    assert len(calls) == 1
+
+
+def test_call_with_retry_raises_once_attempts_are_exhausted(clock, monkeypatch):
+    monkeypatch.setattr(base_handler, "retry_wait_time", lambda e, attempt: 0.0)
+    handler = FakeHandler(max_retries=2)
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise TransientError("service unavailable")
+
+    with pytest.raises(TransientError):
+        handler.call_with_retry("test", request)
+    assert len(calls) == 2
@@ -0,0 +1,57 @@
+import warnings
+from types import SimpleNamespace
+
+import pytest
+
+from utils import cache
+from utils.cache import QueryCache
+
+
+@pytest.fixture
+def clock(monkeypatch) -> list[float]:
+    now = [1000.0]
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_exact_hit_and_ttl(clock):
+    query_cache = QueryCache(ttl=10, max_entries=4)
+    query_cache.set("query", 3, [1.0, 0.0], ["a", "b", "c"])
+    assert query_cache.get("query", 3) == ["a", "b", "c"]
+    assert query_cache.get("query", 5) is None
+    clock[0] += 11
+    assert query_cache.get("query", 3) is None
+    assert query_cache.get_similar([1.0, 0.0], 3) is None
+
+
+def test_semantic_hit_threshold_and_limit(clock):
+    query_cache = QueryCache(ttl=10, max_entries=4, similarity_threshold=0.9)
+    query_cache.set("query", 3, [1.0, 0.0], ["a", "b", "c"])
+    # similarity 0.99 and 0.71
+    assert query_cache.get_similar([0.99, 0.14], 2) == ["a", "b"]
+    assert query_cache.get_similar([1.0, 1.0], 2) is None
+    # results of a lower limit cannot serve a higher one
+    assert query_cache.get_similar([1.0, 0.0], 5) is None
+
+
+def test_ring_buffer_eviction(clock):
+    query_cache = QueryCache(ttl=10, max_entries=2)
+    query_cache.set("first", 3, [1.0, 0.0], ["first"])
+    query_cache.set("second", 3, [0.0, 1.0], ["second"])
+    query_cache.set("third", 3, [-1.0, 0.0], ["third"])
+    # the oldest entry is overwritten, in both levels
+    assert query_cache.get("first", 3) is None
+    assert query_cache.get_similar([1.0, 0.0], 3) is None
+    assert query_cache.get("second", 3) == ["second"]
+    assert query_cache.get("third", 3) == ["third"]
+
+
+def test_zero_vectors_are_misses(clock):
+    query_cache = QueryCache(ttl=10, max_entries=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        query_cache.set("empty", 3, [0.0, 0.0], ["empty"])
+        query_cache.set("query", 3, [1.0, 0.0], ["query"])
+        assert query_cache.get_similar([0.0, 0.0], 3) is None
+        assert query_cache.get_similar([0.0, 1.0], 3) is None
+    assert query_cache.get("empty", 3) == ["empty"]
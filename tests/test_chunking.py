@@ -0,0 +1,80 @@
+import math
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from preprocessing.chunking import (ChunkWithEmbedding, _split_text, add_overlap_to_chunks,
+                                    split_chunks_using_prev_headers)
+
+
+def ocr_response(*markdowns: str) -> SimpleNamespace:
+    return SimpleNamespace(pages=[SimpleNamespace(markdown=md) for md in markdowns])
+
+
+def test_split_text_short_text():
+    assert _split_text("short text", max_chars=100) == ["short text"]
+
+
+@pytest.mark.parametrize("max_chars", [50, 64, 100, 333])
+def test_split_text_even_pieces_at_newlines(max_chars):
+    md = "".join(f"line {i:03d} of the page\n" for i in range(100))
+    pieces = _split_text(md, max_chars)
+    assert "".join(pieces) == md
+    assert len(pieces) >= math.ceil(len(md) / max_chars)
+    assert all(len(piece) <= max_chars for piece in pieces)
+    assert all(piece.endswith("\n") for piece in pieces)
+
+
+def test_split_text_hard_cut_without_newlines():
+    md = "x" * 250
+    pieces = _split_text(md, max_chars=100)
+    assert "".join(pieces) == md
+    assert [len(piece) for piece in pieces] == [84, 83, 83]
+
+
+def test_split_chunks_using_prev_headers():
+    chunks = split_chunks_using_prev_headers(ocr_response(
+        "## A\ntext a\n### A1\ntext a1\n",
+        # less important header than the previous page: the text after "### A1" moves to this chunk
+        "## B\ntext b\n",
+        # more important header in the previous chunk: the text before "#### C" goes to the previous chunk
+        "more b\n#### C\ntext c\n",
+        # same level: the page is added to the previous chunk
+        "#### D\ntext d\n",
+    ))
+    assert [(c.id, c.text) for c in chunks] == [
+        (0, "## A\ntext a\n"),
+        (1, "## B\ntext b\n\n### A1\ntext a1\n\nmore b\n"),
+        (2, "#### C\ntext c\n\n#### D\ntext d\n"),
+    ]
+
+
+def test_add_overlap_to_chunks():
+    first_page = "a" * 1500 + "END"
+    second_page = "START" + "b" * 1500
+    chunks = add_overlap_to_chunks(ocr_response(first_page, second_page))
+    assert [c.id for c in chunks] == [0, 1]
+    # overlaps are the first / last 1000 characters of the adjacent pages, not the whole pages
+    assert chunks[0].text == first_page + "\n\n<\br>PAGE_BREAK<\br>\n\n" + second_page[:1000] + "...\n\n"
+    assert chunks[1].text == "\n\n..." + first_page[-1000:] + "<\br>PAGE_BREAK<\br>" + second_page
+
+
+def test_chunk_with_embedding_json_round_trip():
+    embedding = [0.1, -0.25, 0.333, 1.0]
+    chunk = ChunkWithEmbedding(id=3, text="text", embedding=embedding)
+    loaded = ChunkWithEmbedding.model_validate_json(chunk.model_dump_json())
+    assert loaded.id == 3 and loaded.text == "text"
+    # embeddings are stored as float16
+    assert loaded.embedding == np.asarray(embedding, dtype=np.float16).astype(np.float32).tolist()
+    assert loaded.embedding == pytest.approx(embedding, abs=1e-3)
+    # in-memory dumps keep full precision
+    assert chunk.model_dump()["embedding"] == embedding
+
+
+def test_chunk_with_embedding_from_json_elem():
+    chunk = ChunkWithEmbedding(id=0, text="text", embedding=[0.5, 0.25])
+    loaded = ChunkWithEmbedding.from_json_elem(chunk.model_dump(mode="json"))
+    assert loaded.embedding == [0.5, 0.25]
+    empty = ChunkWithEmbedding.model_validate_json(ChunkWithEmbedding(id=1, text="", embedding=None).model_dump_json())
+    assert empty.embedding is None
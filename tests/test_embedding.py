@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from preprocessing.chunking import Chunk
+from preprocessing.embedding import aembed_and_upsert_chunks
+
+
+class FakeEmbeddingsHandler:
+    embed_model = "fake"
+
+    def __init__(self, fail_at: int | None = None):
+        self.fail_at = fail_at
+        self.calls = 0
+        self.closed = False
+        self._semaphore = asyncio.Semaphore(2)
+
+    async def ainvoke_with_retry(self, method: str, texts: list[str]):
+        async with self._semaphore:
+            self.calls += 1
+            if self.calls == self.fail_at:
+                raise RuntimeError("embedding failed")
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0]) for _ in texts])
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeVectorDB:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.upserted_ids = []
+
+    def create_collection(self, **kwargs):
+        pass
+
+    def upsert(self, collection_name: str, points, wait: bool = False):
+        if self.fail:
+            raise RuntimeError("upsert failed")
+        self.upserted_ids.extend(getattr(points, "ids", []))
+
+
+def chunks(n: int) -> list[Chunk]:
+    return [Chunk(id=i, text=f"chunk {i}") for i in range(n)]
+
+
+def run(coroutine):
+    # failures must not leave the pipeline hanging
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+
+async def assert_stops(coroutine, handler: FakeEmbeddingsHandler, match: str):
+    with pytest.raises(RuntimeError, match=match):
+        await coroutine
+    # no more embedding requests are sent once the error is raised
+    calls = handler.calls
+    await asyncio.sleep(0.1)
+    assert handler.calls == calls
+    assert handler.closed
+
+
+def test_aembed_and_upsert_chunks():
+    handler, vector_db = FakeEmbeddingsHandler(), FakeVectorDB()
+    result = run(aembed_and_upsert_chunks(handler, chunks(10), vector_db, "collection", batch_size=3))
+    assert [c.id for c in result] == list(range(10))
+    assert sorted(vector_db.upserted_ids) == list(range(10))
+    assert handler.closed
+
+
+def test_aembed_and_upsert_chunks_stops_on_embedding_error(tmp_path):
+    handler = FakeEmbeddingsHandler(fail_at=3)
+    run(assert_stops(aembed_and_upsert_chunks(handler, chunks(100), FakeVectorDB(), "collection", batch_size=1,
+                                              embeddings_file=str(tmp_path / "embeddings.jsonl")),
+                     handler, match="embedding failed"))
+
+
+def test_aembed_and_upsert_chunks_stops_on_upsert_error():
+    handler = FakeEmbeddingsHandler()
+    run(assert_stops(aembed_and_upsert_chunks(handler, chunks(100), FakeVectorDB(fail=True), "collection",
+                                              batch_size=1),
+                     handler, match="upsert failed"))
@@ -0,0 +1,98 @@
+import asyncio
+import email.utils
+import time
+
+import httpx
+import pytest
+
+from utils import retry
+from utils.retry import backoff_time, get_retry_after, is_transient_error, retry_on_transient
+
+
+def http_error(status_code: int, headers: dict | None = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://example.com")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def test_is_transient_error():
+    assert is_transient_error(http_error(429))
+    assert is_transient_error(http_error(503))
+    assert is_transient_error(httpx.ConnectError("connection refused"))
+    assert is_transient_error(Exception("Rate limit exceeded"))
+    assert not is_transient_error(http_error(400))
+    assert not is_transient_error(ValueError("invalid input"))
+
+
+def test_get_retry_after_seconds():
+    assert get_retry_after(http_error(429, {"Retry-After": "7"})) == 7.0
+    assert get_retry_after(http_error(429, {"Retry-After": "-3"})) == 0.0
+
+
+def test_get_retry_after_http_date():
+    retry_date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert get_retry_after(http_error(503, {"Retry-After": retry_date})) == pytest.approx(30, abs=2)
+    past_date = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert get_retry_after(http_error(503, {"Retry-After": past_date})) == 0.0
+
+
+def test_get_retry_after_missing_or_invalid():
+    assert get_retry_after(http_error(429)) is None
+    assert get_retry_after(http_error(429, {"Retry-After": "soon"})) is None
+    assert get_retry_after(ValueError("no response")) is None
+
+
+def test_backoff_time():
+    for attempt in range(4):
+        wait_time = backoff_time(attempt, base=1.0, cap=30.0)
+        assert 2 ** attempt <= wait_time <= 2 ** attempt + 1
+    assert backoff_time(10, base=1.0, cap=30.0) == 30.0
+
+
+@pytest.fixture
+def no_wait(monkeypatch):
+    monkeypatch.setattr(retry, "retry_wait_time", lambda e, attempt, base, cap: 0.0)
+
+
+def test_retry_on_transient(no_wait):
+    calls = []
+
+    @retry_on_transient(max_attempts=3)
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise http_error(503)
+        return "ok"
+
+    assert flaky() == "ok"
+    assert len(calls) == 3
+
+
+def test_retry_on_transient_raises(no_wait):
+    calls = []
+
+    @retry_on_transient(max_attempts=3)
+    def failing(error: Exception):
+        calls.append(1)
+        raise error
+
+    with pytest.raises(ValueError):
+        failing(ValueError("invalid input"))
+    assert len(calls) == 1
+    with pytest.raises(httpx.HTTPStatusError):
+        failing(http_error(429))
+    assert len(calls) == 4
+
+
+def test_retry_on_transient_async(no_wait):
+    calls = []
+
+    @retry_on_transient(max_attempts=2)
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 2:
+            raise http_error(502)
+        return "ok"
+
+    assert asyncio.run(flaky()) == "ok"
+    assert len(calls) == 2